@@ -9,7 +9,7 @@ XDGFX, 2020
 
 import os
 
-from ultrasonics import database, plugins, scheduler, webapp
+from ultrasonics import database, plugins, scheduler, sessions, webapp
 
 _ultrasonics = {
     "version": "1.0.0-rc.1",
@@ -20,3 +20,4 @@ database.Core().connect()
 plugins.plugin_gather()
 scheduler.scheduler_start()
 webapp.server_start()
+sessions.close_all()
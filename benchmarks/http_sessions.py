@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+http_sessions
+Benchmark of the shared http sessions against plain `requests` calls.
+
+Starts a local keep-alive stub server, then makes the same requests with module level `requests.get` (a new
+connection for each request), and with `sessions.get` (pooled connections). Requests are made from several
+threads at once, like concurrent applets would.
+
+Usage: python benchmarks/http_sessions.py [requests] [threads]
+
+XDGFX, 2020
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ultrasonics import sessions  # noqa: E402
+
+body = json.dumps({"data": [{"id": i, "title": f"Song {i}"}
+                            for i in range(50)]}).encode()
+body_gzip = gzip.compress(body)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        content = body_gzip if gzipped else body
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark(name, get, url, total, threads):
+    """
+    Make `total` requests to `url` using `get`, spread over `threads` threads, and print requests/sec.
+    """
+    def request(i):
+        resp = get(url, timeout=10)
+        resp.raise_for_status()
+        resp.json()
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(request, range(total)))
+
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:<20} {total / elapsed:>10.1f} requests/sec")
+
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = f"http://127.0.0.1:{server.server_address[1]}/track"
+
+    print(f"{total} requests with {threads} threads to {url}\n")
+
+    benchmark("requests.get", requests.get, url, total, threads)
+    benchmark("sessions.get", sessions.get(url).get, url, total, threads)
+
+    sessions.close_all()
+    server.shutdown()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+checkpoints
+Stage checkpoints, used to resume applet runs which failed part way through.
+
+The songs_dict is saved (compressed) after the inputs and modifiers stages, and progress is recorded after
+each output plugin completes. Output plugins can also record each playlist they finish, using
+`playlist_done` and `playlist_completed`.
+
+If a run fails, the next run of the applet will resume from the last completed step, as long as the applet
+plans are unchanged and the checkpoint is within the freshness window. Checkpoints are removed once a run
+completes successfully.
+
+XDGFX, 2020
+"""
+
+import bz2
+import json
+import time
+
+from ultrasonics import database, logs
+
+log = logs.create_log(__name__)
+
+
+class Checkpoints:
+    """
+    Checkpoints for a single applet run.
+    """
+
+    def __init__(self, applet_id, plans_fingerprint, freshness):
+        """
+        Load any existing checkpoints for the applet which match `plans_fingerprint`, and are less than
+        `freshness` seconds old. A freshness of 0 disables resuming, and nothing is saved.
+        """
+        self.applet_id = applet_id
+        self.enabled = freshness > 0
+        self.plans_fingerprint = plans_fingerprint
+        self.db = database.Checkpoint()
+
+        self.saved = {}
+
+        if self.enabled:
+            for stage, saved_time, plans, data in self.db.get(applet_id):
+                if plans == plans_fingerprint and time.time() - saved_time <= freshness:
+                    self.saved[stage] = json.loads(bz2.decompress(data))
+
+        # Output progress only applies to the songs it was recorded for, so it is only used when resuming
+        # from a saved songs_dict with the same fingerprint
+        resume = self.saved.get("modifiers") or self.saved.get("inputs")
+        self.songs_fingerprint = resume["songs_fingerprint"] if resume else None
+
+        self.progress = self.saved.get("outputs")
+
+        if not self.progress or not resume or self.progress.get("songs_fingerprint") != self.songs_fingerprint:
+            self.progress = {"done": [], "playlists": {}}
+
+        # Index of the output plugin currently running
+        self.output = None
+
+    def load(self, stage):
+        """
+        Get the data saved for `stage`, if a usable checkpoint exists.
+        """
+        return self.saved.get(stage)
+
+    def save(self, stage, data):
+        """
+        Save compressed `data` as the checkpoint for `stage`.
+        """
+        if not self.enabled:
+            return
+
+        data = bz2.compress(json.dumps(data, default=str).encode())
+        self.db.set(self.applet_id, stage, time.time(),
+                    self.plans_fingerprint, data)
+
+    def output_done(self, index):
+        """
+        Check if the output plugin at `index` completed in a previous attempt.
+        """
+        return index in self.progress["done"]
+
+    def output_completed(self, index):
+        """
+        Record that the output plugin at `index` has completed.
+        """
+        if not self.enabled:
+            return
+
+        self.progress["done"].append(index)
+        self.save_progress()
+
+    def playlist_done(self, playlist_name):
+        """
+        Check if the current output plugin completed `playlist_name` in a previous attempt.
+        """
+        return playlist_name in self.progress["playlists"].get(str(self.output), [])
+
+    def playlist_completed(self, playlist_name):
+        """
+        Record that the current output plugin has completed `playlist_name`.
+        """
+        if not self.enabled:
+            return
+
+        self.progress["playlists"].setdefault(
+            str(self.output), []).append(playlist_name)
+        self.save_progress()
+
+    def save_progress(self):
+        """
+        Save output progress, along with the fingerprint of the songs it applies to.
+        """
+        self.progress["songs_fingerprint"] = self.songs_fingerprint
+        self.save("outputs", self.progress)
+
+    def clear(self):
+        """
+        Remove all checkpoints for the applet.
+        """
+        self.db.remove(self.applet_id)
+
+        self.saved = {}
+        self.songs_fingerprint = None
+        self.progress = {"done": [], "playlists": {}}
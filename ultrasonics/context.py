@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+context
+Run context for applets.
+
+A RunContext is built once at the start of an applet run, and holds a snapshot of the applet plans,
+global settings, and persistent settings for every plugin used by the applet. It is passed through every
+stage of the run, so the database is only read once.
+
+It also provides caches scoped to the applet run, which plugins can use to share things like tokens,
+http sessions, or lookups between plugin instances.
+
+XDGFX, 2020
+"""
+
+import threading
+
+from ultrasonics import database, logs, metrics, profiler
+
+log = logs.create_log(__name__)
+
+
+class RunContext:
+    """
+    Snapshot of everything needed for a single applet run.
+    """
+
+    def __init__(self, applet_id, applet_plans=None):
+        self.applet_id = applet_id
+        self.applet_plans = applet_plans or database.Applet().get(applet_id)
+        self.global_settings = database.Core().load(raw=True)
+
+        # Persistent settings for every plugin referenced in the applet, keyed by (name, version)
+        self.plugin_settings = {}
+
+        if self.applet_plans:
+            dbp = database.Plugin()
+
+            for component in ["inputs", "modifiers", "outputs", "triggers"]:
+                for plugin in self.applet_plans.get(component, []):
+                    key = (plugin["plugin"], plugin["version"])
+
+                    if key not in self.plugin_settings:
+                        self.plugin_settings[key] = dbp.get(*key)
+
+        self.profile = profiler.enabled(
+            self.global_settings, self.applet_plans)
+
+        # Checkpoints for resuming the run, set by applet_run
+        self.checkpoints = None
+
+        self.cache = {}
+        self.cache_locks = {}
+        self.lock = threading.Lock()
+
+    def exists(self):
+        """
+        Check if the applet existed in the database when the context was built.
+        """
+        return self.applet_plans is not None
+
+    def settings(self, name, version):
+        """
+        Get the persistent settings for a plugin used in this applet.
+        """
+        key = (name, version)
+
+        if key not in self.plugin_settings:
+            self.plugin_settings[key] = database.Plugin().get(name, version)
+
+        return self.plugin_settings[key]
+
+    def cached(self, key, factory):
+        """
+        Get a value shared by all plugins in this applet run.
+        If `key` is not yet cached, `factory()` is called to create it. Concurrent calls for the same key
+        will wait for the first one to finish, rather than calling `factory` again.
+        """
+        with self.lock:
+            if key in self.cache:
+                metrics.cache_access("run_context", hit=True)
+                return self.cache[key]
+
+            key_lock = self.cache_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                if key in self.cache:
+                    return self.cache[key]
+
+            metrics.cache_access("run_context", hit=False)
+            value = factory()
+
+            with self.lock:
+                self.cache[key] = value
+
+            return value
+
+    def close(self):
+        """
+        Close any cached values which need it (e.g. http sessions) at the end of the run.
+        """
+        with self.lock:
+            values = list(self.cache.values())
+            self.cache.clear()
+
+        for value in values:
+            if callable(getattr(value, "close", None)):
+                try:
+                    value.close()
+                except Exception as e:
+                    log.warning(f"Could not close cached value: {e}")
@@ -10,9 +10,10 @@ XDGFX, 2020
 import ast
 import os
 import sqlite3
+import time
 import uuid
 
-from ultrasonics import logs
+from ultrasonics import logs, metrics, profiler
 
 log = logs.create_log(__name__)
 
@@ -27,6 +28,47 @@ except FileExistsError:
     pass
 
 
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor which reports the number and duration of executed queries to the profiler and metrics.
+    """
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            profiler.track_query(elapsed)
+            metrics.sql_query_seconds.observe(elapsed)
+
+    def executemany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            profiler.track_query(elapsed)
+            metrics.sql_query_seconds.observe(elapsed)
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection which hands out TimedCursor objects.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+def connect(path=db_file):
+    """
+    Open a connection to an sqlite database, with query tracking.
+    Plugins with their own databases should use this instead of sqlite3.connect.
+    """
+    return sqlite3.connect(path, factory=TimedConnection)
+
+
 class Core:
     """
     Core ultrasonics database functions.
@@ -70,6 +112,30 @@ class Core:
             "label": "Trigger Update Polling Interval (s)",
             "name": "trigger_poll",
             "value": "120"
+        },
+        {
+            "type": "string",
+            "value": "If an applet fails part way through a run, the next run can resume from the last completed step instead of starting again 🔁. This only happens if the failed run was within the time below. Set it to 0 to always start from scratch."
+        },
+        {
+            "type": "text",
+            "label": "Resume Failed Runs Within (minutes)",
+            "name": "checkpoint_freshness",
+            "value": "60"
+        },
+        {
+            "type": "string",
+            "value": "Profiling records timings, call traces and resource usage for every plugin run ⏱. It's useful for finding out which plugin is slow, but adds some overhead. It can also be enabled for individual applets."
+        },
+        {
+            "type": "radio",
+            "label": "Profile All Applets",
+            "name": "profiling",
+            "options": [
+                "Yes",
+                "No"
+            ],
+            "value": "No"
         }
     ]
 
@@ -77,7 +143,7 @@ class Core:
         """
         Initial connection to database to create tables.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             from app import _ultrasonics
 
             cursor = conn.cursor()
@@ -100,6 +166,18 @@ class Core:
                 query = "INSERT INTO ultrasonics (key, value) VALUES(?, ?)"
                 cursor.executemany(query, global_settings_database)
 
+            else:
+                # Add any global settings which are newer than the existing database
+                query = "SELECT key FROM ultrasonics"
+                cursor.execute(query)
+                existing_keys = [row[0] for row in cursor.fetchall()]
+
+                global_settings_database = [(item["name"], item["value"])
+                                            for item in self.settings if item["type"] in ["text", "radio", "select"] and item["name"] not in existing_keys]
+
+                query = "INSERT INTO ultrasonics (key, value) VALUES(?, ?)"
+                cursor.executemany(query, global_settings_database)
+
             # Create persistent settings table if needed
             query = "CREATE TABLE IF NOT EXISTS plugins (id INTEGER PRIMARY KEY, plugin TEXT, version FLOAT, settings TEXT)"
             cursor.execute(query)
@@ -108,6 +186,18 @@ class Core:
             query = "CREATE TABLE IF NOT EXISTS applets (id TEXT PRIMARY KEY, lastrun TEXT, data TEXT)"
             cursor.execute(query)
 
+            # Create applet fingerprints table if needed
+            query = "CREATE TABLE IF NOT EXISTS fingerprints (applet_id TEXT PRIMARY KEY, plans TEXT, songs TEXT)"
+            cursor.execute(query)
+
+            # Create applet checkpoints table if needed
+            query = "CREATE TABLE IF NOT EXISTS checkpoints (applet_id TEXT, stage TEXT, time REAL, plans TEXT, data BLOB, PRIMARY KEY (applet_id, stage))"
+            cursor.execute(query)
+
+            # Create profiles table if needed
+            query = "CREATE TABLE IF NOT EXISTS profiles (id TEXT PRIMARY KEY, applet_id TEXT, time REAL, data TEXT)"
+            cursor.execute(query)
+
             conn.commit()
 
             # Version check
@@ -124,7 +214,7 @@ class Core:
         """
         Check if this is a new installation of ultrasonics.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             if update:
                 query = "UPDATE ultrasonics SET value = 0 WHERE key = 'new_install'"
@@ -158,7 +248,7 @@ class Core:
         """
         import copy
 
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "SELECT key, value FROM ultrasonics"
             cursor.execute(query)
@@ -198,7 +288,7 @@ class Core:
         data = [(value, key)
                 for key, value in settings.items() if key != "action"]
 
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "UPDATE ultrasonics SET value = ? WHERE key = ?"
             cursor.executemany(query, data)
@@ -210,7 +300,7 @@ class Core:
         """
         Get a specific value from the ultrasonics core database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "SELECT value FROM ultrasonics WHERE key = ?"
             cursor.execute(query, (key,))
@@ -231,7 +321,7 @@ class Plugin:
         """
         Create a database entry for a given plugin.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "INSERT INTO plugins (plugin, version) VALUES (?,?)"
             cursor.execute(query, (str(name), str(version)))
@@ -242,7 +332,7 @@ class Plugin:
         """
         Update an existing plugin entry in the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "UPDATE plugins SET settings = ? WHERE plugin = ? AND version = ?"
             cursor.execute(query, (str(settings), name, version))
@@ -253,7 +343,7 @@ class Plugin:
         """
         Find plugins with a given name, and return the versions of plugins configured for the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "SELECT version FROM plugins WHERE plugin = ?"
             cursor.execute(query, (name,))
@@ -271,7 +361,7 @@ class Plugin:
         """
         Load the settings from a specific plugin in the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "SELECT settings FROM plugins WHERE plugin = ? AND version = ?"
             cursor.execute(query, (name, version))
@@ -295,7 +385,7 @@ class Applet:
         """
         Return all the applets stored in the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "SELECT id, lastrun, data FROM applets"
             cursor.execute(query)
@@ -328,7 +418,7 @@ class Applet:
         """
         Create or update a new applet.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "REPLACE INTO applets (id, data) VALUES (?,?)"
             cursor.execute(
@@ -340,7 +430,7 @@ class Applet:
         """
         Load an applet plans from it's unique id.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "SELECT data FROM applets WHERE id = ?"
             cursor.execute(query, (applet_id, ))
@@ -357,10 +447,16 @@ class Applet:
         """
         Delete an applet from the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "DELETE FROM applets WHERE id = ?"
             cursor.execute(query, (applet_id,))
+
+            query = "DELETE FROM fingerprints WHERE applet_id = ?"
+            cursor.execute(query, (applet_id,))
+
+            query = "DELETE FROM checkpoints WHERE applet_id = ?"
+            cursor.execute(query, (applet_id,))
             conn.commit()
             log.info("Applet database entry deleted")
 
@@ -368,10 +464,129 @@ class Applet:
         """
         Update the lastrun column for an applet with the supplied data.
         """
-        with sqlite3.connect(db_file) as conn:
+        with connect() as conn:
             cursor = conn.cursor()
             query = "UPDATE applets SET lastrun = ? WHERE id = ?"
             cursor.execute(
                 query, (str(data), str(applet_id)))
             conn.commit()
             log.info("Applet lastrun updated")
+
+    def fingerprint_get(self, applet_id):
+        """
+        Get the fingerprints of the applet plans and input songs from the last successful run.
+
+        @return: (plans, songs) or None if no fingerprint exists
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "SELECT plans, songs FROM fingerprints WHERE applet_id = ?"
+            cursor.execute(query, (applet_id,))
+            rows = cursor.fetchall()
+
+            return rows[0] if rows else None
+
+    def fingerprint_set(self, applet_id, plans, songs):
+        """
+        Save the fingerprints of the applet plans and input songs after a successful run.
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "REPLACE INTO fingerprints (applet_id, plans, songs) VALUES (?,?,?)"
+            cursor.execute(query, (str(applet_id), plans, songs))
+            conn.commit()
+
+
+class Checkpoint:
+    """
+    Functions specific to applet run checkpoints.
+    """
+
+    def get(self, applet_id):
+        """
+        Get all checkpoints for an applet.
+
+        @return: list of (stage, time, plans, data) tuples
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "SELECT stage, time, plans, data FROM checkpoints WHERE applet_id = ?"
+            cursor.execute(query, (applet_id,))
+            return cursor.fetchall()
+
+    def set(self, applet_id, stage, saved_time, plans, data):
+        """
+        Create or update the checkpoint for a stage of an applet run.
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "REPLACE INTO checkpoints (applet_id, stage, time, plans, data) VALUES (?,?,?,?,?)"
+            cursor.execute(query, (str(applet_id), stage,
+                                   saved_time, plans, sqlite3.Binary(data)))
+            conn.commit()
+
+    def remove(self, applet_id):
+        """
+        Delete all checkpoints for an applet.
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "DELETE FROM checkpoints WHERE applet_id = ?"
+            cursor.execute(query, (applet_id,))
+            conn.commit()
+
+
+class Profile:
+    """
+    Functions specific to plugin profiling results.
+    """
+
+    def add(self, profile_id, applet_id, data):
+        """
+        Store the summary of a profiled plugin run.
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "INSERT INTO profiles (id, applet_id, time, data) VALUES (?,?,?,?)"
+            cursor.execute(
+                query, (profile_id, str(applet_id), data["time"], str(data)))
+            conn.commit()
+
+    def gather(self, limit=None):
+        """
+        Return stored profile summaries, newest first.
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "SELECT id, data FROM profiles ORDER BY time DESC"
+
+            if limit:
+                query += f" LIMIT {int(limit)}"
+
+            cursor.execute(query)
+            rows = cursor.fetchall()
+
+            data = []
+
+            for profile_id, profile_data in rows:
+                profile_data = ast.literal_eval(profile_data)
+                profile_data["profile_id"] = profile_id
+                data.append(profile_data)
+
+            return data
+
+    def prune(self, keep):
+        """
+        Remove all but the newest `keep` profiles, returning the ids of those removed.
+        """
+        with connect() as conn:
+            cursor = conn.cursor()
+            query = "SELECT id FROM profiles ORDER BY time DESC LIMIT -1 OFFSET ?"
+            cursor.execute(query, (keep,))
+            removed = [row[0] for row in cursor.fetchall()]
+
+            query = "DELETE FROM profiles WHERE id = ?"
+            cursor.executemany(query, [(profile_id,) for profile_id in removed])
+            conn.commit()
+
+            return removed
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""
+metrics
+In-memory operational metrics, exposed in the Prometheus text format at /metrics.
+
+All values are kept in memory and updated as things happen, so rendering them is cheap and never touches
+the database. Gauges which depend on other parts of ultrasonics (e.g. the scheduler pool) are read from
+a callback when rendered.
+
+XDGFX, 2020
+"""
+
+import threading
+import time
+
+registry = []
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(labels, extra=None):
+    """
+    Convert a tuple of (key, value) label pairs to Prometheus format.
+    """
+    labels = list(labels) + list(extra or [])
+
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+class Metric:
+    """
+    Base class for all metrics, which registers itself for rendering.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+        registry.append(self)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}"
+        ]
+
+        lines.extend(self.samples())
+
+        return lines
+
+    def samples(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    """
+    A value which only ever increases.
+    """
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(tuple(sorted(labels.items())), 0)
+
+
+class Gauge(Metric):
+    """
+    A value which can go up and down. If `function` is supplied, it is called to get the value when rendered.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, description, function=None):
+        super().__init__(name, description)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.function:
+            try:
+                self.set(self.function())
+            except Exception:
+                # Never fail a scrape because of one gauge
+                pass
+
+        return super().samples()
+
+
+class Histogram(Metric):
+    """
+    Counts observations (e.g. durations) in configurable buckets.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, description, buckets=default_buckets):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0,
+                    "count": 0
+                }
+
+            entry = self.values[key]
+
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    entry["buckets"][i] += 1
+
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def samples(self):
+        lines = []
+
+        with self.lock:
+            for labels, entry in self.values.items():
+                for bucket, count in zip(self.buckets, entry["buckets"]):
+                    lines.append(
+                        f"{self.name}_bucket{format_labels(labels, [('le', bucket)])} {count}")
+
+                lines.append(
+                    f"{self.name}_bucket{format_labels(labels, [('le', '+Inf')])} {entry['count']}")
+                lines.append(
+                    f"{self.name}_sum{format_labels(labels)} {entry['sum']}")
+                lines.append(
+                    f"{self.name}_count{format_labels(labels)} {entry['count']}")
+
+        return lines
+
+    def time(self, **labels):
+        """
+        Context manager which observes the time taken inside it.
+        """
+        return Timer(self, labels)
+
+
+class Timer:
+    """
+    Observes the duration of a `with` block in a Histogram.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(
+            time.perf_counter() - self.start, **self.labels)
+
+
+def render():
+    """
+    Render all registered metrics in the Prometheus text format.
+    """
+    lines = []
+
+    for metric in registry:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+def cache_access(cache, hit):
+    """
+    Record a hit or miss for a named cache.
+    """
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def cache_hit_ratios():
+    """
+    Hit ratio for every cache which has been accessed.
+    """
+    with cache_requests.lock:
+        totals = {}
+
+        for labels, value in cache_requests.values.items():
+            labels = dict(labels)
+            hits, count = totals.get(labels["cache"], (0, 0))
+
+            if labels["result"] == "hit":
+                hits += value
+
+            totals[labels["cache"]] = (hits, count + value)
+
+    return {cache: hits / count for cache, (hits, count) in totals.items() if count}
+
+
+class CacheRatioGauge(Gauge):
+    """
+    Gauge of hit ratios, computed from the cache_requests counter when rendered.
+    """
+
+    def samples(self):
+        with self.lock:
+            self.values = {(("cache", cache),): ratio
+                           for cache, ratio in cache_hit_ratios().items()}
+
+        return super().samples()
+
+
+# --- METRICS ---
+applet_runs = Counter("ultrasonics_applet_runs_total",
+                      "Applet runs, by result.")
+applet_run_seconds = Histogram("ultrasonics_applet_run_duration_seconds",
+                               "Duration of complete applet runs.")
+plugin_run_seconds = Histogram("ultrasonics_plugin_run_duration_seconds",
+                               "Duration of individual plugin runs, by plugin and component.")
+plugin_failures = Counter("ultrasonics_plugin_run_failures_total",
+                          "Plugin runs which raised an exception, by plugin and component.")
+http_requests = Counter("ultrasonics_http_requests_total",
+                        "HTTP requests made to external services, by host and status code.")
+http_request_seconds = Histogram("ultrasonics_http_request_duration_seconds",
+                                 "Duration of HTTP requests made to external services, by host.")
+sql_query_seconds = Histogram("ultrasonics_sqlite_query_duration_seconds",
+                              "Duration of SQLite queries.",
+                              buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+cache_requests = Counter("ultrasonics_cache_requests_total",
+                         "Cache lookups, by cache name and result (hit or miss).")
+cache_hit_ratio = CacheRatioGauge("ultrasonics_cache_hit_ratio",
+                                  "Ratio of cache lookups which were hits, by cache name.")
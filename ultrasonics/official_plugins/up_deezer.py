@@ -11,18 +11,33 @@ XDGFX, 2020
 
 import json
 import os
+import random
 import re
-import time
 
-import requests
 from tqdm import tqdm
 
 from app import _ultrasonics
-from ultrasonics import logs
-from ultrasonics.tools import api_key, fuzzymatch, name_filter
+from ultrasonics import logs, sessions
+from ultrasonics.tools import (api_key, disk_cache, fuzzymatch, name_filter,
+                               parallel, rate_limit)
 
 log = logs.create_log(__name__)
 
+# Seconds to cache track details for. Details of a released track rarely change
+track_cache_ttl = 30 * 24 * 60 * 60
+
+# Maximum number of concurrent song searches, and track details fetched concurrently for each
+search_threads = 8
+detail_threads = 8
+
+# Deezer allows 50 requests every 5 seconds, shared by every Deezer applet.
+# Requests are spaced out evenly without bursts, as a full bucket would allow twice the quota in the first window
+limiter = rate_limit.get("deezer", rate=50, per=5, burst=1)
+
+# Number of times a request is retried after exceeding the quota, and the first wait in seconds
+quota_retries = 5
+quota_backoff = 5
+
 handshake = {
     "name": "deezer",
     "description": "sync your playlists to and from deezer",
@@ -86,6 +101,7 @@ def run(settings_dict, **kwargs):
     component = kwargs["component"]
     applet_id = kwargs["applet_id"]
     songs_dict = kwargs["songs_dict"]
+    context = kwargs.get("context")
 
     class Deezer:
         """
@@ -98,42 +114,51 @@ def run(settings_dict, **kwargs):
 
             @return: response JSON if successful
             """
-            if method == "GET":
-                r = requests.get(url, params=params)
+            if method not in ["GET", "POST", "DELETE"]:
+                raise Exception(f"Unknown api method: {method}")
 
-                if r.status_code == 4:
-                    time.sleep(5)
-                    r = requests.get(url, params=params)
+            session = sessions.get(url)
 
-            elif method == "POST":
-                r = requests.post(url, data=data)
+            for attempt in range(quota_retries + 1):
+                limiter.acquire()
 
-                if r.status_code == 4:
-                    time.sleep(5)
-                    r = requests.post(url, data=data)
+                if method == "POST":
+                    r = session.post(url, data=data)
+                else:
+                    r = session.request(method, url, params=params)
 
-            elif method == "DELETE":
-                r = requests.delete(url, params=params)
+                try:
+                    error = r.json().get("error") if r.status_code == 200 else None
+                except (AttributeError, ValueError):
+                    # Returned data is not in JSON format
+                    error = None
 
-                if r.status_code == 4:
-                    time.sleep(5)
-                    r = requests.post(url, data=data)
+                # Deezer reports an exceeded quota as error code 4, in a normal 200 response
+                quota_exceeded = r.status_code == 429 or (
+                    isinstance(error, dict) and error.get("code") == 4)
 
-            else:
-                raise Exception(f"Unknown api method: {method}")
+                if not quota_exceeded:
+                    break
+
+                if attempt == quota_retries:
+                    log.error("Deezer quota still exceeded, giving up.")
+                    raise UserWarning(error or "Quota exceeded")
+
+                # Back off exponentially, with jitter so waiting threads don't all retry at once
+                delay = quota_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                log.warning(
+                    f"Deezer quota exceeded, retrying in {delay:.1f} seconds.")
+
+                limiter.penalise(delay)
 
             if r.status_code != 200:
                 log.error(f"Unexpected status code: {r.status_code}")
                 log.error(r.text)
                 raise Exception("Unexpected status code")
 
-            try:
-                if r.json().get("error"):
-                    log.error(f"An error was returned from the Deezer API.")
-                    raise UserWarning(r.json()["error"])
-            except AttributeError:
-                # Returned data is not in JSON format
-                pass
+            if error:
+                log.error(f"An error was returned from the Deezer API.")
+                raise UserWarning(error)
 
             return r.json()
 
@@ -171,12 +196,16 @@ def run(settings_dict, **kwargs):
             try:
                 # If ISRC exists, only use that query
                 url = f"https://api.deezer.com/2.0/track/isrc:{track['isrc']}"
-                resp = self.api(url)
 
-                if resp.get("error"):
+                try:
+                    resp = self.api(url)
+                except UserWarning:
                     # ISRC was not found in Deezer
                     raise KeyError
 
+                # The response already has full track details
+                track_cache.set(str(resp["id"]), resp)
+
                 results_list.append(self.deezer_to_songs_dict(track=resp))
 
             except KeyError:
@@ -214,6 +243,7 @@ def run(settings_dict, **kwargs):
 
                 # Execute all queries
                 url = "https://api.deezer.com/search"
+                result_ids = []
 
                 for query in queries:
                     params = {
@@ -222,10 +252,16 @@ def run(settings_dict, **kwargs):
                     }
 
                     results = self.api(url, params=params)["data"]
+                    result_ids.extend(str(result["id"]) for result in results)
+
+                # Get details of every result at once, then convert to ultrasonics format
+                result_ids = list(dict.fromkeys(result_ids))
+                details = self.track_details(result_ids)
 
-                    # Convert to ultrasonics format and append to results_list
-                    for result in results:
-                        result = self.deezer_to_songs_dict(result=result)
+                for result_id in result_ids:
+                    if result_id in details:
+                        result = self.deezer_to_songs_dict(
+                            track=details[result_id])
                         if result not in results_list:
                             results_list.append(result)
 
@@ -279,6 +315,12 @@ def run(settings_dict, **kwargs):
             """
             Returns a list of tracks in a playlist.
             """
+            return self.convert_tracks(self.playlist_items(playlist_id))
+
+        def playlist_items(self, playlist_id):
+            """
+            Returns every track in a playlist, as listed in the playlist pages (without full track details).
+            """
             limit = 100
 
             url = f"https://api.deezer.com/playlist/{playlist_id}/tracks"
@@ -298,20 +340,68 @@ def run(settings_dict, **kwargs):
                 tracks_response = self.api(tracks_response["next"])
                 tracks.extend(tracks_response["data"])
 
+            return tracks
+
+        def convert_tracks(self, tracks):
+            """
+            Converts tracks from playlist pages to ultrasonics format.
+            Tracks whose details can't be fetched are left out.
+            """
+            # Playlist pages don't include contributors, ISRC or release date
+            details = self.track_details([track["id"] for track in tracks])
+
             track_list = []
 
             # Convert from Deezer API format to ultrasonics format
             log.info("Converting tracks to ultrasonics format.")
-            for track in tqdm(tracks, desc=f"Converting tracks in {playlist_id}"):
+            for track in tracks:
                 try:
-                    track_list.append(self.deezer_to_songs_dict(result=track))
-                except UserWarning as e:
+                    track_list.append(
+                        self.deezer_to_songs_dict(track=details[str(track["id"])]))
+                except KeyError:
                     log.warning(
                         f"Unexpected response from Deezer for track {track}.")
-                    log.warning(e)
 
             return track_list
 
+        def track_details(self, track_ids):
+            """
+            Get full track details for many Deezer track ids at once.
+            Details are read from the track cache, and any missing tracks are fetched concurrently.
+
+            @return: dict of {track id: track details}, without any tracks which couldn't be fetched
+            """
+            track_ids = [str(track_id) for track_id in track_ids]
+            details = track_cache.get_many(track_ids)
+
+            def fetch(track_id):
+                url = f"https://api.deezer.com/track/{track_id}"
+
+                try:
+                    return track_id, self.api(url)
+                except UserWarning as e:
+                    log.warning(
+                        f"Unexpected response from Deezer for track {track_id}.")
+                    log.warning(e)
+                    return track_id, None
+
+            missing = [track_id for track_id in dict.fromkeys(track_ids)
+                       if track_id not in details]
+
+            if missing:
+                log.debug(f"Fetching details for {len(missing)} track(s).")
+
+                fetched = {
+                    track_id: track for track_id, track in parallel.map(
+                        fetch, missing, threads=detail_threads)
+                    if track
+                }
+
+                track_cache.set_many(fetched)
+                details.update(fetched)
+
+            return details
+
         def remove_tracks_from_playlist(self, playlist_id, tracks):
             """
             Removes all occurrences of `tracks` from the specified playlist.
@@ -332,9 +422,12 @@ def run(settings_dict, **kwargs):
             """
             if result:
                 # Get additional info about the track
-                url = f"https://api.deezer.com/track/{result['id']}"
-
-                track = self.api(url)
+                try:
+                    track = self.track_details([result["id"]])[
+                        str(result["id"])]
+                except KeyError:
+                    raise UserWarning(
+                        f"Could not get details of track {result['id']}")
 
             artists = [item["name"] for item in track["contributors"]]
 
@@ -369,6 +462,14 @@ def run(settings_dict, **kwargs):
 
             return item
 
+    # Full track details, shared by every Deezer applet
+    track_cache = disk_cache.DiskCache(
+        os.path.join(_ultrasonics["config_dir"],
+                     "up_deezer", "track_cache.db"),
+        "deezer_tracks",
+        ttl=track_cache_ttl
+    )
+
     dz = Deezer()
     dz.token = re.match("access_token=([\w]+)&", database["auth"]).groups()[0]
 
@@ -406,7 +507,15 @@ def run(settings_dict, **kwargs):
         # Get a list of current user playlists
         current_playlists = dz.list_playlists()
 
+        checkpoints = context.checkpoints if context else None
+
         for playlist in songs_dict:
+            # Skip playlists completed in a previous failed run
+            if checkpoints and checkpoints.playlist_done(playlist["name"]):
+                log.info(
+                    f"Playlist {playlist['name']} was already synced in a previous run, skipping.")
+                continue
+
             # Check the playlist already exists in Deezer
             playlist_id = ""
             try:
@@ -419,6 +528,10 @@ def run(settings_dict, **kwargs):
             if playlist_id:
                 log.info(
                     f"Playlist {playlist['name']} already exists, updating that one.")
+
+                # Get all tracks already in the playlist
+                existing_items = dz.playlist_items(playlist_id)
+                existing_tracks = dz.convert_tracks(existing_items)
             else:
                 # Playlist must be created
                 log.info(
@@ -448,64 +561,69 @@ def run(settings_dict, **kwargs):
                     raise Exception(
                         f"Unexpected response while updating playlist: {response}")
 
+                existing_items = []
                 existing_tracks = []
-                existing_ids = []
 
-            # Get all tracks already in the playlist
-            if "existing_tracks" not in vars():
-                existing_tracks = dz.playlist_tracks(playlist_id)
-                existing_ids = [str(item["id"]["deezer"])
-                                for item in existing_tracks]
+            # Taken from the playlist pages, so tracks which couldn't be converted are still included
+            existing_ids = {str(item["id"]) for item in existing_items}
 
             # Add songs which don't already exist in the playlist
             new_ids = []
-            duplicate_ids = []
+            added_ids = set()
+            duplicate_ids = set()
 
-            log.info("Searching for matching songs in Deezer.")
-            for song in tqdm(playlist["songs"], desc=f"Searching Deezer for songs from {playlist['name']}"):
-                # First check for fuzzy duplicate without Deezer api search
-                duplicate = False
-                for item in existing_tracks:
-                    score = fuzzymatch.similarity(song, item)
-
-                    if score > float(database.get("fuzzy_ratio") or 90):
-                        # Duplicate was found
-                        duplicate_ids.append(item['id']['deezer'])
-                        duplicate = True
-                        break
+            # Index the existing tracks, so duplicates are found without comparing every song
+            fuzzy_ratio = float(database.get("fuzzy_ratio") or 90)
+            existing_index = fuzzymatch.SongIndex(existing_tracks)
+
+            # First check for duplicates without Deezer api search
+            search_songs = []
+
+            for song in playlist["songs"]:
+                item = existing_index.match(song, fuzzy_ratio)
 
-                if duplicate:
-                    continue
+                if item:
+                    duplicate_ids.add(str(item["id"]["deezer"]))
+                else:
+                    search_songs.append(song)
 
+            def search(song):
                 try:
-                    deezer_id, confidence = dz.search(song)
+                    return dz.search(song)
                 except UserWarning:
                     # Likely no data was returned
                     log.warning(
                         f"No data was returned when searching for song: {song}")
-                    continue
+                    return "", 0
+
+            # Search for all other songs concurrently, results are kept in playlist order
+            log.info("Searching for matching songs in Deezer.")
+            results = parallel.map(
+                search, search_songs, threads=search_threads,
+                desc=f"Searching Deezer for songs from {playlist['name']}")
 
-                if deezer_id in existing_ids:
-                    duplicate_ids.append(deezer_id)
+            for song, (deezer_id, confidence) in zip(search_songs, results):
+                deezer_id = str(deezer_id)
 
-                if confidence > float(database.get("fuzzy_ratio") or 90):
-                    new_ids.append(str(deezer_id))
-                else:
+                if confidence <= fuzzy_ratio:
                     log.debug(
                         f"Could not find song {song['title']} in Deezer; will not add to playlist.")
 
+                elif deezer_id in existing_ids:
+                    duplicate_ids.add(deezer_id)
+
+                elif deezer_id not in added_ids:
+                    new_ids.append(deezer_id)
+                    added_ids.add(deezer_id)
+
             if settings_dict["existing_playlists"] == "Update":
-                # Remove any songs which aren't in `uris` from the playlist
-                remove_ids = [
-                    deezer_id for deezer_id in existing_ids if deezer_id not in new_ids + duplicate_ids]
+                # Remove any songs which weren't matched from the playlist
+                remove_ids = list(existing_ids - duplicate_ids)
 
                 # Skip if no songs are to be removed
                 if remove_ids:
                     dz.remove_tracks_from_playlist(playlist_id, remove_ids)
 
-            # Remove duplicates from the list of new ids
-            new_ids = list(set(new_ids))
-
             # Add tracks to playlist in batches of 100
             url = f"https://api.deezer.com/playlist/{playlist_id}/tracks"
             data = {
@@ -522,6 +640,9 @@ def run(settings_dict, **kwargs):
                 data["songs"] = ",".join(new_ids)
                 dz.api(url, method="POST", data=data)
 
+            if checkpoints:
+                checkpoints.playlist_completed(playlist["name"])
+
 
 def builder(**kwargs):
     component = kwargs["component"]
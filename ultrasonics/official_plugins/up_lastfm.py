@@ -10,14 +10,50 @@ XDGFX, 2020
 """
 
 import json
+import math
+import os
+import time
 
-import requests
-from tqdm import tqdm
-
-from ultrasonics import logs
+from app import _ultrasonics
+# Renamed, as `database` holds the plugin settings inside run()
+from ultrasonics import database as ultrasonics_database
+from ultrasonics import logs, sessions
+from ultrasonics.tools import disk_cache, parallel, rate_limit
 
 log = logs.create_log(__name__)
 
+# Largest page size allowed by the last.fm api
+page_size = 200
+
+# Maximum number of pages fetched concurrently
+page_threads = 4
+
+# Maximum number of concurrent track.getinfo requests
+album_threads = 4
+
+# Seconds to cache track albums for, and tracks which had no album
+album_cache_ttl = 30 * 24 * 60 * 60
+album_cache_negative_ttl = 7 * 24 * 60 * 60
+
+# last.fm asks for no more than 5 requests per second, shared by every last.fm applet
+limiter = rate_limit.get("lastfm", rate=5, per=1)
+
+# Number of times a rate limited request is retried, and the first wait in seconds
+rate_limit_retries = 5
+rate_limit_backoff = 2
+
+# Length in seconds of each time period option
+period_seconds = {
+    "Now": 0,
+    "1 Day": 86400,
+    "7 Days": 604800,
+    "1 Month": 2629800,
+    "3 Months": 7889400,
+    "6 Months": 15778800,
+    "1 Year": 31557600,
+    "2 Years": 62208000,
+}
+
 handshake = {
     "name": "lastfm",
     "description": "rediscover your past favourites, and curate based on your listening history.",
@@ -40,12 +76,21 @@ handshake = {
 }
 
 
+def album_key(song):
+    """
+    Album cache key for a song, from its normalised artist and title.
+    """
+    return "\n".join(" ".join(value.lower().split())
+                     for value in [song["artists"][0] or "", song["title"]])
+
+
 def run(settings_dict, **kwargs):
     """
     1. Determines which mode the plugin is running in:
         - Loved songs
         - Top songs
         - Recent songs (time period)
+        - New scrobbles (rolling window, stored locally, only newer scrobbles are requested)
     2. Gets the songs from last.fm, up to the specified limit.
     3. Converts the songs to ultrasonics songs_dict, making more requests for album data if needed.
     """
@@ -57,70 +102,188 @@ def run(settings_dict, **kwargs):
     songs_dict = kwargs["songs_dict"]
 
     url = global_settings["api_url"] + "lastfm"
+    session = sessions.get(url)
+
+    # Albums found with track.getinfo, shared by every last.fm applet
+    album_cache = disk_cache.DiskCache(
+        os.path.join(_ultrasonics["config_dir"], "up_lastfm", "album_cache.db"),
+        "lastfm_albums",
+        ttl=album_cache_ttl,
+        negative_ttl=album_cache_negative_ttl
+    )
+
+    class Scrobbles:
+        """
+        Class for interactions with the up_lastfm database.
+        Stores a rolling window of scrobbles for each applet, and the time of the newest scrobble seen.
+        """
+
+        def __init__(self):
+            # Create database if required
+            self.scrobbles_db = os.path.join(
+                _ultrasonics["config_dir"], "up_lastfm", "scrobbles.db")
+
+            # Create the containing folder if it doesn't already exist
+            try:
+                os.mkdir(os.path.dirname(self.scrobbles_db))
+            except FileExistsError:
+                # Folder already exists
+                pass
+
+            with ultrasonics_database.connect(self.scrobbles_db) as conn:
+                cursor = conn.cursor()
+
+                query = "CREATE TABLE IF NOT EXISTS scrobbles (applet_id TEXT, uts INTEGER, url TEXT, track TEXT, PRIMARY KEY (applet_id, uts, url))"
+                cursor.execute(query)
+
+                query = "CREATE TABLE IF NOT EXISTS scrobbles_cursor (applet_id TEXT PRIMARY KEY, uts INTEGER)"
+                cursor.execute(query)
+
+                conn.commit()
+
+        def cursor_get(self):
+            """
+            Gets the time of the newest scrobble seen, or None if this applet hasn't run before.
+            """
+            with ultrasonics_database.connect(self.scrobbles_db) as conn:
+                cursor = conn.cursor()
+
+                query = "SELECT uts FROM scrobbles_cursor WHERE applet_id = ?"
+                cursor.execute(query, (applet_id,))
 
-    def get_songs(params):
+                rows = cursor.fetchone()
+
+                return None if not rows else rows[0]
+
+        def cursor_set(self, uts):
+            """
+            Stores the time of the newest scrobble seen.
+            """
+            with ultrasonics_database.connect(self.scrobbles_db) as conn:
+                cursor = conn.cursor()
+
+                query = "REPLACE INTO scrobbles_cursor (applet_id, uts) VALUES (?, ?)"
+                cursor.execute(query, (applet_id, uts))
+
+                conn.commit()
+
+        def add(self, tracks):
+            """
+            Stores new scrobbles, in lastfm format.
+            """
+            values = [
+                (applet_id, int(track["date"]["uts"]),
+                 track["url"], json.dumps(track))
+                for track in tracks
+            ]
+
+            with ultrasonics_database.connect(self.scrobbles_db) as conn:
+                cursor = conn.cursor()
+
+                query = "INSERT OR IGNORE INTO scrobbles (applet_id, uts, url, track) VALUES (?, ?, ?, ?)"
+                cursor.executemany(query, values)
+
+                conn.commit()
+
+        def remove_before(self, uts):
+            """
+            Removes scrobbles older than `uts`, which have left the rolling window.
+            """
+            with ultrasonics_database.connect(self.scrobbles_db) as conn:
+                cursor = conn.cursor()
+
+                query = "DELETE FROM scrobbles WHERE applet_id = ? AND uts < ?"
+                cursor.execute(query, (applet_id, uts))
+
+                conn.commit()
+
+        def get(self, limit):
+            """
+            Gets up to `limit` stored scrobbles in lastfm format, newest first.
+            """
+            with ultrasonics_database.connect(self.scrobbles_db) as conn:
+                cursor = conn.cursor()
+
+                query = "SELECT track FROM scrobbles WHERE applet_id = ? ORDER BY uts DESC LIMIT ?"
+                cursor.execute(query, (applet_id, limit))
+
+                return [json.loads(row[0]) for row in cursor.fetchall()]
+
+    def request(params):
+        """
+        Sends a request to the lastfm api, waiting for the shared rate limiter.
+        Rate limited requests are retried with exponential backoff.
+
+        @return: response JSON
+        """
+        for attempt in range(rate_limit_retries + 1):
+            limiter.acquire()
+
+            r = session.get(url, params=params)
+
+            # last.fm can also report the rate limit as error 29 in the response body
+            rate_limited = r.status_code == 429
+            if not rate_limited and r.status_code != 200:
+                try:
+                    rate_limited = json.loads(r.content).get("error") == 29
+                except (AttributeError, ValueError):
+                    pass
+
+            if not rate_limited or attempt == rate_limit_retries:
+                break
+
+            delay = rate_limit_backoff * 2 ** attempt
+            log.warning(
+                f"Rate limit reached, retrying in {delay} seconds...")
+
+            limiter.penalise(delay)
+
+        if r.status_code != 200:
+            log.error(f"Unexpected status code: {r.status_code}")
+            log.error(r.text)
+            raise Exception("Unexpected status code")
+
+        return json.loads(r.content)
+
+    def get_songs(params, limited=True):
         """
         Sends requests to the lastfm api to return a list of songs.
-        The number of songs will not exceed settings_dict["limit"].
-        Checks for invalid responses.
+        The number of songs will not exceed settings_dict["limit"], unless `limited` is False.
+        The first page gives the total number of pages, then all other pages needed are fetched concurrently.
 
         @return: list of songs in lastfm format
         """
         default_params = {
             "user": database["username"],
-            "format": "json"
+            "format": "json",
+            "limit": page_size
         }
 
         # Add params for all requests
         params.update(default_params)
 
-        limit = int(settings_dict["limit"])
-
-        left = limit
-        page = 1
+        limit = int(settings_dict["limit"]) if limited else None
 
         log.info(f"Song limit set to: {limit}")
 
-        tracks = []
-
-        while left > 0:
-            params["page"] = page
-            params["limit"] = 50
-
-            r = requests.get(url, params=params)
-
-            if r.status_code == 429:
-                import time
-                log.warning("Rate limit reached, sleeping for a while...")
-                time.sleep(60)
-                r = requests.get(url, params=params)
-
-            if r.status_code != 200:
-                log.error(f"Unexpected status code: {r.status_code}")
-                log.error(r.text)
-                raise Exception("Unexpected status code")
+        def get_page(page):
+            r = request({**params, "page": page})
+            return list(r.values())[0]
 
-            r = json.loads(r.content)
+        first = get_page(1)
 
-            # Add all new songs to existing data list
-            new_songs = list(r.values())[0]["track"]
+        total_pages = int(first["@attr"]["totalPages"])
+        last_page = min(total_pages, math.ceil(limit / page_size)) \
+            if limited else total_pages
 
-            # Check for now playing, and remove if so
-            now_playing = new_songs[0].get("@attr", {}).get("nowplaying")
-            if now_playing:
-                new_songs.pop(0)
-                left += 1
+        pages = [first] + parallel.map(get_page, range(2, last_page + 1),
+                                       threads=page_threads)
 
-            # Update tracks list with required number of tracks
-            tracks_selection = left if left < 50 else 50
-            tracks.extend(new_songs[:tracks_selection])
-
-            # Check if there are no more songs left to get
-            if int(list(r.values())[0]["@attr"]["totalPages"]) <= page:
-                left = -1
-
-            left -= 50
-            page += 1
+        # Remove the now playing track, which is returned in addition to the page of songs
+        tracks = [
+            track for page in pages for track in page["track"]
+            if not track.get("@attr", {}).get("nowplaying")
+        ][:limit]
 
         log.info(f"Found {len(tracks)} tracks.")
         return tracks
@@ -128,20 +291,13 @@ def run(settings_dict, **kwargs):
     def convert_songs(songs):
         """
         Converts a list of songs in lastfm format to ultrasonics format.
+        Albums missing from the songs are looked up with track.getinfo, using the album cache first.
 
         @return: list of songs in ultrasonics format.
         """
-        params = {
-            "format": "json",
-            "method": "track.getinfo",
-            "autocorrect": "0"
-        }
-
         new_songs = []
 
-        log.info("Getting updated tags for all songs from lastfm...")
-
-        for song in tqdm(songs):
+        for song in songs:
             temp_dict = {
                 "title": song["name"],
                 "artists": [
@@ -153,34 +309,45 @@ def run(settings_dict, **kwargs):
                 }
             }
 
-            # Make request to get album info
-            if not temp_dict["album"]:
-                params["track"] = song["name"]
-                params["artist"] = temp_dict["artists"][0]
+            new_songs.append(temp_dict)
+
+        # Get album info for songs without it
+        lookups = {
+            album_key(song): song for song in new_songs if not song["album"]
+        }
+        albums = album_cache.get_many(lookups)
+
+        def get_album(key):
+            song = lookups[key]
+            params = {
+                "format": "json",
+                "method": "track.getinfo",
+                "autocorrect": "0",
+                "track": song["title"],
+                "artist": song["artists"][0]
+            }
 
-                r = requests.get(url, params=params)
+            return key, request(params).get("track", {}).get(
+                "album", {}).get("title") or ""
 
-                if r.status_code == 429:
-                    import time
-                    log.warning("Rate limit reached, sleeping for a while...")
-                    time.sleep(60)
-                    r = requests.get(url, params=params)
+        missing = [key for key in lookups if key not in albums]
 
-                if r.status_code != 200:
-                    log.error(f"Unexpected status code: {r.status_code}")
-                    log.error(r.text)
-                    raise Exception("Unexpected status code")
+        if missing:
+            log.info("Getting updated tags for songs from lastfm...")
 
-                album = json.loads(r.content).get("track", {}).get(
-                    "album", {}).get("title")
+            # Songs without an album are cached too, so they aren't looked up every run
+            found = dict(parallel.map(get_album, missing,
+                                      threads=album_threads, desc="Getting albums"))
 
-                if album:
-                    temp_dict["album"] = album
+            album_cache.set_many(found)
+            albums.update(found)
 
-            if not temp_dict["album"]:
-                del temp_dict["album"]
+        for song in new_songs:
+            if not song["album"]:
+                song["album"] = albums.get(album_key(song))
 
-            new_songs.append(temp_dict)
+            if not song["album"]:
+                del song["album"]
 
         return new_songs
 
@@ -194,21 +361,10 @@ def run(settings_dict, **kwargs):
         log.info("Getting recent tracks from last.fm")
         from datetime import datetime
 
-        converter = {
-            "Now": 0,
-            "1 Day": 86400,
-            "7 Days": 604800,
-            "1 Month": 2629800,
-            "3 Months": 7889400,
-            "6 Months": 15778800,
-            "1 Year": 31557600,
-            "2 Years": 62208000,
-        }
-
         time_to = (datetime.utcnow() - datetime(1970, 1, 1)
-                   ).total_seconds() - converter[settings_dict["period-end"].rstrip(" Ago")]
+                   ).total_seconds() - period_seconds[settings_dict["period-end"].rstrip(" Ago")]
 
-        duration = converter[settings_dict["period-duration"]]
+        duration = period_seconds[settings_dict["period-duration"]]
 
         time_from = time_to - duration
 
@@ -218,6 +374,35 @@ def run(settings_dict, **kwargs):
             "to": str(int(time_to))
         }
 
+    elif settings_dict["select"] == "New Scrobbles":
+        log.info("Getting new scrobbles from last.fm")
+
+        scrobbles = Scrobbles()
+
+        now = int(time.time())
+        window_start = now - \
+            period_seconds[settings_dict.get("window") or "1 Month"]
+
+        # Only request scrobbles newer than the last one seen, or the whole window on the first run
+        cursor = max(scrobbles.cursor_get() or 0, window_start)
+
+        params = {
+            "method": "user.getrecenttracks",
+            "from": str(cursor + 1)
+        }
+
+        new_tracks = get_songs(params, limited=False)
+
+        scrobbles.add(new_tracks)
+        scrobbles.remove_before(window_start)
+
+        if new_tracks:
+            scrobbles.cursor_set(
+                max(int(track["date"]["uts"]) for track in new_tracks))
+
+        songs = scrobbles.get(int(settings_dict["limit"]))
+        params = None
+
     elif settings_dict["select"] == "Top Tracks":
         log.info("Getting top tracks from last.fm")
 
@@ -233,7 +418,9 @@ def run(settings_dict, **kwargs):
     else:
         raise Exception(f"Invalid select option: {settings_dict['select']}")
 
-    songs = get_songs(params)
+    if params:
+        songs = get_songs(params)
+
     songs = convert_songs(songs)
 
     songs_dict = [
@@ -254,6 +441,7 @@ def test(database, **kwargs):
     global_settings = kwargs["global_settings"]
 
     url = global_settings["api_url"] + "lastfm"
+    session = sessions.get(url)
 
     params = {
         "method": "user.getinfo",
@@ -264,7 +452,7 @@ def test(database, **kwargs):
     log.info(f"Trying last.fm api at url: {url}")
     log.info(f"Using username: {params['user']}")
 
-    r = requests.get(url, params=params)
+    r = session.get(url, params=params)
 
     if r.status_code != 200:
         log.error(f"Unexpected status code: {r.status_code}")
@@ -296,6 +484,9 @@ def builder(**kwargs):
             <input class="is-checkradio" type="radio" name="select" id="Recent Tracks" value="Recent Tracks">
             <label for="Recent Tracks">Recent Tracks</label>
 
+            <input class="is-checkradio" type="radio" name="select" id="New Scrobbles" value="New Scrobbles">
+            <label for="New Scrobbles">New Scrobbles</label>
+
             <input class="is-checkradio" type="radio" name="select" id="Top Tracks" value="Top Tracks">
             <label for="Top Tracks">Top Tracks</label>
         </div>
@@ -357,6 +548,22 @@ def builder(**kwargs):
                 </div>
             </div>
         </div>
+
+        <div class="field shy new-scrobbles-only">
+            <label class="label">Rolling Window (Only New Scrobbles Are Requested Each Run)</label>
+            <div class="control">
+                <div class="select">
+                    <select name="window">
+                        <option>1 Day</option>
+                        <option>7 Days</option>
+                        <option selected>1 Month</option>
+                        <option>3 Months</option>
+                        <option>6 Months</option>
+                        <option>1 Year</option>
+                    </select>
+                </div>
+            </div>
+        </div>
     </div>
 
     <script type="text/javascript">
@@ -387,6 +594,10 @@ def builder(**kwargs):
                     unhide = document.querySelectorAll(
                         ".shy-elements .shy.recent-only")
                     break
+                case "New Scrobbles":
+                    unhide = document.querySelectorAll(
+                        ".shy-elements .shy.new-scrobbles-only")
+                    break
                 case "Top Tracks":
                     unhide = document.querySelectorAll(
                         ".shy-elements .shy.top-tracks-only")
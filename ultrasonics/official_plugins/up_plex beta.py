@@ -24,11 +24,22 @@ import plexapi.server
 import plexapi.exceptions
 import plexapi.playlist
 from tqdm import tqdm
-from ultrasonics import logs
-from ultrasonics.tools import local_tags, fuzzymatch
+
+from app import _ultrasonics
+from ultrasonics import logs, sessions
+from ultrasonics.tools import disk_cache, local_tags, fuzzymatch
 
 log = logs.create_log(__name__)
 
+# Number of tracks requested in each page when loading a library index
+index_page_size = 1000
+
+# Seconds to keep library indexes for, they are also replaced whenever the library is updated
+index_cache_ttl = 30 * 24 * 60 * 60
+
+# Number of matched tracks fetched from Plex in each request
+fetch_batch_size = 100
+
 handshake = {
     "name": "plex beta",
     "description": "Sync playlists to and from Plex Media Server.",
@@ -89,13 +100,91 @@ def run(settings_dict, **kwargs):
 
         return track_dict
 
+    def plexapi_to_index(track) -> dict:
+        """
+        Converts a track from a library listing to a song dict, using only the artist and album fields
+        already included in the listing (no extra requests are made).
+        """
+        track_dict = {
+            "title": track.title,
+            # Track artist is only included if it differs from the album artist
+            "artists": [track.originalTitle or track.grandparentTitle],
+            "album": track.parentTitle,
+            "date": str(track.year) if track.year else None,
+            "id": {"plex": track.key},
+            "location": track.locations[0] if track.locations else None,
+            "duration": track.duration,
+        }
+
+        return {k: v for k, v in track_dict.items() if v}
+
+    def library_index(library) -> list:
+        """
+        Gets every track in a library as song dicts, loading all tracks at once.
+        The index is cached on disk, and only loaded again once the library has been updated.
+        """
+        key = f"{library.uuid}:{library.key}"
+        updated_at = library.updatedAt.timestamp() if library.updatedAt else None
+
+        cached = library_cache.get(key)
+
+        if cached is not disk_cache.missing and cached["updated_at"] == updated_at:
+            log.debug(f"Using cached index for library: {library.title}")
+            return cached["tracks"]
+
+        log.info(f"Loading all tracks from library: {library.title}")
+        tracks = [
+            plexapi_to_index(track)
+            for track in library.searchTracks(container_size=index_page_size)
+        ]
+
+        library_cache.set(key, {"updated_at": updated_at, "tracks": tracks})
+
+        return tracks
+
+    def fetch_tracks(keys) -> dict:
+        """
+        Fetches plexapi track objects for many track keys, in batches.
+
+        @return: dict of {track key: track}
+        """
+        keys = list(dict.fromkeys(keys))
+        tracks = {}
+
+        for i in range(0, len(keys), fetch_batch_size):
+            rating_keys = [
+                key.rsplit("/", 1)[-1] for key in keys[i : i + fetch_batch_size]
+            ]
+
+            ekey = f"/library/metadata/{','.join(rating_keys)}"
+
+            for track in plex.fetchItems(ekey):
+                tracks[track.key] = track
+
+        return tracks
+
     database = kwargs["database"]
     global_settings = kwargs["global_settings"]
     component = kwargs["component"]
     applet_id = kwargs["applet_id"]
     songs_dict = kwargs["songs_dict"]
+    context = kwargs.get("context")
+
+    # Library track indexes, checked against each library's updatedAt time
+    library_cache = disk_cache.DiskCache(
+        os.path.join(
+            _ultrasonics["config_dir"], "up_plex beta", "library_index.db"
+        ),
+        "plex_libraries",
+        ttl=index_cache_ttl,
+        max_entries=100,
+    )
 
-    plex = plexapi.server.PlexServer(database["server_url"], database["plex_token"])
+    plex = plexapi.server.PlexServer(
+        database["server_url"],
+        database["plex_token"],
+        session=sessions.get(database["server_url"]),
+    )
 
     if component == "inputs":
         songs_dict = []
@@ -158,9 +247,30 @@ def run(settings_dict, **kwargs):
         if preferred_library:
             libraries.insert(0, preferred_library)
 
+        # Index every track once, so songs are matched locally instead of searching Plex for each one
+        indexes = {library.key: library_index(library) for library in libraries}
+
+        preferred_index = (
+            fuzzymatch.SongIndex(indexes[preferred_library.key])
+            if preferred_library
+            else None
+        )
+        all_index = fuzzymatch.SongIndex(
+            [track for tracks in indexes.values() for track in tracks]
+        )
+
+        fuzzy_ratio = float(settings_dict["fuzzy_ratio"])
+
         # Loop over supplied songs_dict and check for pre-existing playlists on Plex
         # If a playlist exists, add songs to it. If not, create it.
+        checkpoints = context.checkpoints if context else None
+
         for playlist in tqdm(songs_dict, desc="Processing playlists"):
+            # Skip playlists completed in a previous failed run
+            if checkpoints and checkpoints.playlist_done(playlist["name"]):
+                log.info(
+                    f"Playlist {playlist['name']} was already synced in a previous run, skipping.")
+                continue
 
             log.info(f"Processing playlist: {playlist['name']}")
 
@@ -172,42 +282,30 @@ def run(settings_dict, **kwargs):
 
             # Loop over songs in playlist and search for them in Plex, appending
             # to the playlist if found.
-            songs_to_add = []
+            matched_keys = []
             for song in tqdm(playlist["songs"], desc="Adding songs"):
 
-                # Check if song exists on Plex
-                plex_songs = preferred_library.search(
-                    title=song["title"], libtype="track", maxresults=10
-                )
+                # Check if song exists in the preferred library
+                match = None
+                if preferred_index:
+                    match = preferred_index.match(song, fuzzy_ratio)
 
-                # If no match is found, check other libraries
-                if not plex_songs:
-                    for library in libraries:
-                        plex_songs.extend(
-                            library.search(title=song["title"], libtype="track")
-                        )
+                # If no match is found, check all libraries
+                if not match:
+                    match = all_index.match(song, fuzzy_ratio)
 
                 # If still no match is found, log it and skip it
-                if not plex_songs:
+                if not match:
                     log.warning(f"Song {song['title']} not found on Plex. Skipping...")
                     continue
 
-                # Convert songs to ultrasonics format
-                plex_songs_ultrasonics = [
-                    plexapi_to_ultrasonics(song) for song in plex_songs
-                ]
-
-                # Compare similarity of songs to find the best match
-                scores = [
-                    fuzzymatch.similarity(song, plex_song)
-                    for plex_song in plex_songs_ultrasonics
-                ]
-
-                # If there's a match, add it to the playlist
-                if max(scores) >= float(settings_dict["fuzzy_ratio"]):
-                    songs_to_add.append(plex_songs[scores.index(max(scores))])
-                else:
-                    log.warning(f"Song {song['title']} not found on Plex. Skipping...")
+                matched_keys.append(match["id"]["plex"])
+
+            # Get the matched tracks from Plex in a few requests, keeping playlist order
+            plex_tracks = fetch_tracks(matched_keys)
+            songs_to_add = [
+                plex_tracks[key] for key in matched_keys if key in plex_tracks
+            ]
 
             log.info(
                 f"Found {len(songs_to_add)} songs in Plex out of {len(playlist['songs'])} songs supplied"
@@ -254,6 +352,9 @@ def run(settings_dict, **kwargs):
 
                     log.info(f"Successfully updated playlist: {playlist['name']}")
 
+            if checkpoints:
+                checkpoints.playlist_completed(playlist["name"])
+
 
 def test(database, **kwargs):
     """
@@ -262,7 +363,11 @@ def test(database, **kwargs):
     global_settings = kwargs["global_settings"]
 
     try:
-        plex = plexapi.server.PlexServer(database["server_url"], database["plex_token"])
+        plex = plexapi.server.PlexServer(
+            database["server_url"],
+            database["plex_token"],
+            session=sessions.get(database["server_url"]),
+        )
     except plexapi.exceptions.Unauthorized:
         raise plexapi.exceptions.Unauthorized(
             "Invalid Plex Token. Please check your settings."
@@ -285,7 +390,11 @@ def builder(**kwargs):
     global_settings = kwargs["global_settings"]
     component = kwargs["component"]
 
-    plex = plexapi.server.PlexServer(database["server_url"], database["plex_token"])
+    plex = plexapi.server.PlexServer(
+        database["server_url"],
+        database["plex_token"],
+        session=sessions.get(database["server_url"]),
+    )
 
     # Select all audio libraries, and append their corresponding key
     sections = [
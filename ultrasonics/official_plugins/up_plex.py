@@ -19,14 +19,17 @@ from collections import OrderedDict
 from urllib.parse import urlencode
 from xml.etree import ElementTree
 
-import requests
-from tqdm import tqdm
-
-from ultrasonics import logs
-from ultrasonics.tools import local_tags
+from ultrasonics import logs, sessions
+from ultrasonics.tools import local_tags, parallel
 
 log = logs.create_log(__name__)
 
+# Maximum number of playlists fetched from Plex concurrently
+playlist_threads = 4
+
+# Maximum number of music files read concurrently for each playlist, when reading tags from files
+tag_threads = 8
+
 handshake = {
     "name": "plex",
     "description": "Sync playlists to and from Plex Media Server.",
@@ -105,37 +108,80 @@ def run(settings_dict, **kwargs):
     component = kwargs["component"]
     applet_id = kwargs["applet_id"]
     songs_dict = kwargs["songs_dict"]
+    context = kwargs.get("context")
+
+    session = sessions.get(database["server_url"])
 
     def fetch_playlist(key):
+        """
+        Fetch a playlist from Plex, returning its title and songs.
+        The playlist XML is parsed as it is downloaded, and each track is discarded once read,
+        so large playlists are never held in memory all at once.
+        Songs are built from the Plex metadata, unless tags should be read from the music files.
+        """
         url = f"{database['server_url']}{key}?X-Plex-Token={database['plex_token']}"
 
-        resp = requests.get(url, timeout=30, verify=check_ssl)
-
-        if resp.status_code != 200:
-            raise Exception(
-                f"Unexpected status code received from Plex: {resp.status_code}")
-
-        root = ElementTree.fromstring(resp.text)
-
-        title = root.get("title")
-
-        playlist = []
-        for document in tqdm(root.findall("Track"), desc=f"Fetching songs from playlist: {title}"):
-            song = document[0][0].get('file')
-
+        with session.get(url, timeout=30, verify=check_ssl, stream=True) as resp:
+            if resp.status_code != 200:
+                raise Exception(
+                    f"Unexpected status code received from Plex: {resp.status_code}")
+
+            # Undo any gzip encoding while streaming
+            resp.raw.decode_content = True
+
+            root = None
+            tracks = []
+
+            for event, element in ElementTree.iterparse(resp.raw, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = element
+                        title = element.get("title")
+
+                elif element.tag == "Track":
+                    tracks.append({
+                        "title": element.get("title"),
+                        # Track artist is only included if it differs from the album artist
+                        "artist": element.get("originalTitle") or element.get("grandparentTitle"),
+                        "album": element.get("parentTitle"),
+                        "date": element.get("parentYear") or element.get("year"),
+                        "tracknumber": element.get("index"),
+                        "file": element[0][0].get('file')
+                    })
+
+                    # Free the finished track
+                    root.clear()
+
+        def convert(track):
             # Convert path to be usable by ultrasonics
-            song_path = remove_prepend(song)
+            song_path = remove_prepend(track["file"])
             song_path = convert_path(song_path)
             song_path = os.path.join(
                 database["ultrasonics_prepend"], song_path)
 
-            try:
-                song_dict = local_tags.tags(song_path)
-            except Exception as e:
-                log.error(f"Could not load tags from song: {song_path}")
-                log.error(e)
-
-            playlist.append(song_dict)
+            if read_file_tags:
+                try:
+                    return local_tags.tags(song_path)
+                except Exception as e:
+                    log.error(f"Could not load tags from song: {song_path}")
+                    log.error(e)
+
+            # Use the metadata already sent by Plex
+            song_dict = {
+                "title": track["title"],
+                "artists": [track["artist"]] if track["artist"] else None,
+                "album": track["album"],
+                "date": track["date"],
+                "tracknumber": track["tracknumber"],
+                "location": song_path
+            }
+
+            return {k: v for k, v in song_dict.items() if v}
+
+        if read_file_tags:
+            playlist = parallel.map(convert, tracks, threads=tag_threads)
+        else:
+            playlist = [convert(track) for track in tracks]
 
         return title, playlist
 
@@ -179,7 +225,7 @@ def run(settings_dict, **kwargs):
     log.info(
         f"Requesting playlists from endpoint: {url.replace(database['plex_token'], '***********')}")
 
-    resp = requests.get(url, timeout=30, verify=check_ssl)
+    resp = session.get(url, timeout=30, verify=check_ssl)
 
     if resp.status_code != 200:
         raise Exception(
@@ -187,12 +233,12 @@ def run(settings_dict, **kwargs):
 
     root = ElementTree.fromstring(resp.text)
 
-    keys = []
+    playlists = []
     for document in root.findall("Playlist"):
         if document.get('smart') == "0" and document.get('playlistType') == "audio":
-            keys.append(document.get('key'))
+            playlists.append((document.get('key'), document.get('title')))
 
-    log.info(f"Found {len(keys)} playlists.")
+    log.info(f"Found {len(playlists)} playlists.")
 
     enable_convert_path = False
     ultrasonics_unix = database["ultrasonics_prepend"].startswith("/")
@@ -206,21 +252,30 @@ def run(settings_dict, **kwargs):
     if component == "inputs":
         songs_dict = []
 
-        # Copies Plex playlists to .ultrasonics_tmp folder in music directory
-        for key in keys:
-            name, playlist = fetch_playlist(key)
+        # Tags are only read from the music files if requested, otherwise Plex metadata is used
+        read_file_tags = settings_dict.get("song_tags") == "Music Files"
 
-            # Check if title matches regex setting
-            if re.match(settings_dict["filter"], name, re.IGNORECASE):
-                log.info(f"Fetching playlist: {name}")
+        # Check if title matches regex setting, before fetching any songs
+        playlists = [
+            (key, title) for key, title in playlists
+            if re.match(settings_dict["filter"], title or "", re.IGNORECASE)
+        ]
 
-                songs_dict_entry = {
-                    "name": name,
-                    "id": {},
-                    "songs": playlist
-                }
+        log.info(f"{len(playlists)} playlists match the filter.")
+
+        # Fetch all playlists concurrently, over the shared Plex session
+        results = parallel.map(
+            lambda item: fetch_playlist(item[0]), playlists,
+            threads=playlist_threads, desc="Fetching playlists from Plex")
 
-                songs_dict.append(songs_dict_entry)
+        for name, playlist in results:
+            songs_dict_entry = {
+                "name": name,
+                "id": {},
+                "songs": playlist
+            }
+
+            songs_dict.append(songs_dict_entry)
 
         return songs_dict
 
@@ -239,7 +294,17 @@ def run(settings_dict, **kwargs):
         log.info("Creating temporary playlists to send to Plex.")
         os.makedirs(temp_path)
 
+        checkpoints = context.checkpoints if context else None
+
         for item in songs_dict:
+            # Skip playlists completed in a previous failed run
+            if checkpoints and checkpoints.playlist_done(item["name"]):
+                log.info(
+                    f"Playlist {item['name']} was already synced in a previous run, skipping.")
+                continue
+
+            playlist_name = item["name"]
+
             log.info(f"Updating playlist: {item['name']}")
 
             # Replace invalid characters in playlist title
@@ -290,13 +355,16 @@ def run(settings_dict, **kwargs):
             querystring = urlencode(OrderedDict(
                 [("sectionID", section_id), ("path", playlist_path_plex), ("X-Plex-Token", database["plex_token"])]))
 
-            response = requests.post(
+            response = session.post(
                 url, data="", headers=headers, params=querystring, verify=check_ssl)
 
             # Should return nothing but if there's an issue there may be an error shown
             if not response.text == '':
                 log.debug(response.text)
 
+            if checkpoints:
+                checkpoints.playlist_completed(playlist_name)
+
         # Remove the temporary folder
         shutil.rmtree(temp_path)
 
@@ -306,12 +374,13 @@ def test(database, **kwargs):
     Checks if Plex Media Server responds to API requests.
     """
     global_settings = kwargs["global_settings"]
+    session = sessions.get(database["server_url"])
 
     log.debug("Checking that Plex responds to API requests...")
     url = f"{database['server_url']}/playlists/?X-Plex-Token={database['plex_token']}"
     check_ssl = database["check_ssl"] == "Yes"
 
-    resp = requests.get(url, timeout=5, verify=check_ssl)
+    resp = session.get(url, timeout=5, verify=check_ssl)
 
     if resp.status_code == 200:
         log.debug("Test successful.")
@@ -353,11 +422,12 @@ def builder(**kwargs):
     database = kwargs["database"]
     global_settings = kwargs["global_settings"]
     component = kwargs["component"]
+    session = sessions.get(database["server_url"])
 
     url = f"{database['server_url']}/library/sections/?X-Plex-Token={database['plex_token']}"
     check_ssl = "check_ssl" in database.keys()
 
-    resp = requests.get(url, timeout=30, verify=check_ssl)
+    resp = session.get(url, timeout=30, verify=check_ssl)
 
     if resp.status_code != 200:
         raise Exception(
@@ -405,6 +475,20 @@ def builder(**kwargs):
                     "label": "Filter",
                     "name": "filter",
                     "value": ""
+                },
+                {
+                    "type": "string",
+                    "value": "Song tags are normally taken from the Plex library. You can read them from the music files instead, which is slower but includes extra tags such as ISRC."
+                },
+                {
+                    "type": "radio",
+                    "label": "Song Tags",
+                    "name": "song_tags",
+                    "id": "song_tags",
+                    "options": [
+                        "Plex Metadata",
+                        "Music Files"
+                    ]
                 }
             ]
         )
@@ -47,6 +47,7 @@ def run(settings_dict, **kwargs):
     component          Either "inputs", "modifiers", "outputs", or "trigger"
     applet_id          The unique identifier for this specific applet
     songs_dict         If a modifier or output, the songs dictionary to be used
+    context            RunContext for the applet run (may be None), with caches shared between plugins
 
     @return:
     If an input or modifier, the new songs_dict must be returned.
@@ -8,24 +8,26 @@ Creates new playlists based on a seed input.
 XDGFX, 2020
 """
 
-import bz2
 import json
 import os
-import pickle
 import random
 import re
-from urllib.parse import urlencode, urljoin
+from collections import Counter
+from urllib.parse import urlencode
 
-import requests
 import spotipy
-from tqdm import tqdm
 
 from app import _ultrasonics
 from ultrasonics import logs
-from ultrasonics.tools import api_key, fuzzymatch
+from ultrasonics.tools import (disk_cache, fuzzymatch, parallel, rate_limit,
+                               spotify_token)
 
 log = logs.create_log(__name__)
 
+# Seconds to cache search results for, and searches which found nothing
+search_cache_ttl = 30 * 24 * 60 * 60
+search_cache_negative_ttl = 24 * 60 * 60
+
 handshake = {
     "name": "spotify mixer",
     "description": "generate brand new playlists from an input playlist",
@@ -80,123 +82,43 @@ def run(settings_dict, **kwargs):
         Class for interactions with Spotify through the Spotipy api.
         """
 
-        def __init__(self):
-            # Use same cache as up_spotify
-            self.cache_file = os.path.join(
-                _ultrasonics["config_dir"], "up_spotify", "up_spotify.bz2")
-
-            log.info(f"Credentials will be cached in: {self.cache_file}")
-
-            # Create the containing folder if it doesn't already exist
-            try:
-                os.mkdir(os.path.dirname(self.cache_file))
-            except FileExistsError:
-                # Folder already exists
-                pass
-
-        def token_get(self, force=False):
-            """
-            Updates the global access_token variable, in the following order of preference:
-            1. A locally saved access token.
-            2. Renews token using the database refresh_token.
-
-            If #2, the access token is saved to a .cache file.
-            """
-            log.debug("Fetching your Spotify token")
-            if os.path.isfile(self.cache_file) and not force:
-                with bz2.BZ2File(self.cache_file, "r") as f:
-                    raw = json.loads(pickle.load(f))
-                    token = raw["access_token"]
-
-                # Checks that the cached token is valid
-                if self.token_validate(token):
-                    log.debug("Returning cached token")
-                    return token
-
-            # In all other cases, renew the token
-            log.debug("Returning renewed token")
-            return self.token_renew()
-
-        def token_validate(self, token):
-            """
-            Checks if an auth token is valid, by making a request to the Spotify api.
-            """
-            url = f"https://api.spotify.com/v1/search"
-            params = {
-                "q": "Flume",
-                "type": "artist"
-            }
-            headers = {
-                "Authorization": f"Bearer {token}"
-            }
-
-            resp = requests.get(url, headers=headers, params=params)
-
-            if resp.status_code == 200:
-                log.debug("Token is valid.")
-                return True
-
-            elif resp.status_code == 401:
-                log.debug("Token is not valid.")
-                return False
-
-            else:
-                log.error(f"Unexpected status code: {resp.status_code}")
-                raise Exception(resp.text)
-
-        def token_renew(self):
-            """
-            Using refresh_token, requests and saves a new access token.
-            """
-
-            url = urljoin(self.api_url, "spotify/auth/renew")
-            data = {
-                "refresh_token": self.refresh_token,
-                "ultrasonics_auth_hash": api_key.get_hash(True)
-            }
-
-            log.info(
-                "Requesting a new Spotify token, this may take a few seconds...")
-
-            # Request with a long timeout to account for free Heroku start-up 😉
-            resp = requests.post(url, data=data, timeout=60)
-
-            if resp.status_code == 200:
-                token = resp.json()["access_token"]
-
-                log.debug(
-                    f"Spotify renew data: {resp.text.replace(token, '***************')}")
-
-                with bz2.BZ2File(self.cache_file, "w") as f:
-                    pickle.dump(resp.text, f)
-
-                return token
-
-            else:
-                log.error(resp.text)
-                raise Exception(
-                    f"The response `when renewing Spotify token was unexpected: {resp.status_code}")
-
         def request(self, sp_func, *args, **kwargs):
             """
             Used to call a spotipy function, with automatic catching and renewing on access token errors.
             """
             errors = 0
+            rate_limited = 0
 
             while errors <= 1:
+                spotify_token.limiter.acquire()
+
                 try:
                     return sp_func(*args, **kwargs)
 
                 except spotipy.exceptions.SpotifyException as e:
-                    # Renew token
+                    # Rate limited, so all Spotify requests wait before trying again
+                    if e.http_status == 429 and rate_limited < 5:
+                        retry_after = rate_limit.retry_after(e.headers)
+                        log.warning(
+                            f"Spotify rate limit reached, waiting {retry_after} seconds.")
+
+                        spotify_token.limiter.penalise(retry_after)
+                        rate_limited += 1
+                        continue
+
                     log.error(e)
-                    self.sp = spotipy.Spotify(auth=self.token_get(force=True))
+
+                    # Renew token if it was rejected
+                    if e.http_status == 401:
+                        self.tokens.renew()
+
                     errors += 1
+                    error = e
                     continue
 
             log.error(
                 "An error occurred while trying to contact the Spotify api.")
-            raise Exception(e)
+            raise Exception(error)
 
         def search(self, track):
             """
@@ -273,11 +195,7 @@ def run(settings_dict, **kwargs):
 
             # Execute all queries
             for query in queries:
-                results = self.request(self.sp.search, query)
-
-                # Convert to ultrasonics format and append to results_list
-                for item in results["tracks"]["items"]:
-                    item = s.spotify_to_songs_dict(item)
+                for item in self.search_query(query):
                     if item not in results_list:
                         results_list.append(item)
 
@@ -300,6 +218,30 @@ def run(settings_dict, **kwargs):
 
             return spotify_id, confidence
 
+        def search_query(self, query):
+            """
+            Search Spotify for tracks matching `query`, returning them in ultrasonics format.
+            Results are cached on disk (ISRC queries by ISRC), so repeated searches skip the api.
+            """
+            if query.startswith("isrc:"):
+                cache = isrc_cache
+                key = query[len("isrc:"):].strip().upper()
+            else:
+                cache = query_cache
+                key = " ".join(query.lower().split())
+
+            items = cache.get(key)
+
+            if items is disk_cache.missing:
+                results = self.request(self.sp.search, query)
+
+                items = [self.spotify_to_songs_dict(item)
+                         for item in results["tracks"]["items"]]
+
+                cache.set(key, items)
+
+            return items
+
         def recommendations(self, seed_tracks):
             """
             Get a list of recommended tracks for input seeds.
@@ -347,6 +289,23 @@ def run(settings_dict, **kwargs):
 
             return item
 
+    # Search results are shared with the other Spotify plugin
+    search_cache_file = os.path.join(
+        _ultrasonics["config_dir"], "up_spotify", "search_cache.db")
+
+    isrc_cache = disk_cache.DiskCache(
+        search_cache_file,
+        "spotify_isrc",
+        ttl=search_cache_ttl,
+        negative_ttl=search_cache_negative_ttl,
+    )
+    query_cache = disk_cache.DiskCache(
+        search_cache_file,
+        "spotify_search",
+        ttl=search_cache_ttl,
+        negative_ttl=search_cache_negative_ttl,
+    )
+
     s = Spotify()
 
     s.api_url = global_settings["api_url"]
@@ -354,10 +313,16 @@ def run(settings_dict, **kwargs):
     auth = json.loads(database["auth"])
     s.refresh_token = auth["refresh_token"]
 
-    s.sp = spotipy.Spotify(auth=s.token_get(), requests_timeout=60)
+    # Access tokens are renewed automatically before they expire
+    s.tokens = spotify_token.TokenManager(s.api_url, s.refresh_token)
+    s.sp = spotipy.Spotify(
+        auth_manager=s.tokens, requests_session=spotify_token.session(), requests_timeout=60)
 
     playlist_titles = settings_dict["playlist_titles"].split(",")
 
+    # Mixes are repeatable if a seed is supplied
+    rng = random.Random(settings_dict.get("seed") or None)
+
     for playlist_index, playlist in enumerate(songs_dict):
         # Convert playlist title if requested
         new_title = playlist_titles[playlist_index] if playlist_index < len(
@@ -369,12 +334,14 @@ def run(settings_dict, **kwargs):
         if songs_dict[playlist_index]["name"] == new_title.strip():
             songs_dict[playlist_index]["id"] = {}
 
-        spotify_ids = []
-
+        # Search for all songs concurrently, keeping playlist order
         log.info("Searching for matching songs in Spotify.")
-        for song in tqdm(playlist["songs"], desc=f"Searching Spotify for songs from {playlist['name']}"):
-            spotify_id, confidence = s.search(song)
+        results = parallel.map(
+            s.search, playlist["songs"], desc=f"Searching Spotify for songs from {playlist['name']}")
 
+        spotify_ids = []
+
+        for song, (spotify_id, confidence) in zip(playlist["songs"], results):
             if not spotify_id:
                 continue
 
@@ -387,34 +354,32 @@ def run(settings_dict, **kwargs):
         # If spotify_ids length is smaller or equal to 50, then take all of the items
         item_limit = 50
         if len(spotify_ids) > item_limit:
-            spotify_ids = random.sample(spotify_ids, item_limit)
+            spotify_ids = rng.sample(spotify_ids, item_limit)
 
         # Slice spotify ids into sublists of len(5)
         spotify_ids = [spotify_ids[i:i+5]
                        for i in range(0, len(spotify_ids), 5)]
 
-        # Get recommendations for each seed from Spotify, append to results
-        results = []
-        for seed in tqdm(spotify_ids, desc="Fetching recommendations"):
-            results.extend(s.recommendations(seed))
+        # Get recommendations for each seed from Spotify concurrently
+        recommendations = parallel.map(
+            s.recommendations, spotify_ids, desc="Fetching recommendations")
 
-        # Find any duplicate songs and mark as best_results
-        best_results = [x for n, x in enumerate(
-            results) if x in results[:n]]
+        # Count how many seeds recommended each track
+        tracks = {}
+        counts = Counter()
 
-        # Remove duplicates from remaining results
-        results = [x for x in results if x not in best_results]
+        for track in [track for seed_tracks in recommendations for track in seed_tracks]:
+            tracks.setdefault(track["id"], track)
+            counts[track["id"]] += 1
 
-        # Concat length of best_results to 50 if > 50
-        if len(best_results) > int(settings_dict["playlist_length"] or 50):
-            best_results = random.sample(best_results, int(
-                settings_dict["playlist_length"] or 50))
+        # Rank tracks by how often they were recommended, with random order between equal counts
+        tiebreak = {track_id: rng.random() for track_id in tracks}
+        ranked = sorted(tracks, key=lambda track_id: (
+            -counts[track_id], tiebreak[track_id]))
 
-        # Fill best_results until requested playlist length is reached
-        while len(best_results) < int(settings_dict["playlist_length"] or 50) and len(results) > 0:
-            i = random.randint(0, len(results) - 1)
-            best_results.append(results[i])
-            del results[i]
+        playlist_length = int(settings_dict["playlist_length"] or 50)
+        best_results = [tracks[track_id]
+                        for track_id in ranked[:playlist_length]]
 
         # Convert to ultrasonics format
         songs_list = [s.spotify_to_songs_dict(song) for song in best_results]
@@ -425,6 +390,14 @@ def run(settings_dict, **kwargs):
     return songs_dict
 
 
+def deterministic(settings_dict):
+    """
+    Mixes are only repeatable with a random seed. Without one, the applet runs in full every time, even
+    if its inputs haven't changed.
+    """
+    return bool(settings_dict.get("seed"))
+
+
 def builder(**kwargs):
     database = kwargs["database"]
     global_settings = kwargs["global_settings"]
@@ -454,6 +427,16 @@ def builder(**kwargs):
             "label": "Output Playlist Length",
             "name": "playlist_length",
             "value": "50"
+        },
+        {
+            "type": "string",
+            "value": "Songs recommended for more of your input songs are picked first 🎯. Set a random seed if you'd like the same input to always give the same mix, or leave it blank for a fresh mix every time the applet runs. With a seed set, the applet is skipped while its input songs are unchanged."
+        },
+        {
+            "type": "text",
+            "label": "Random Seed",
+            "name": "seed",
+            "value": ""
         }
     ]
 
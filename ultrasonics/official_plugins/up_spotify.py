@@ -9,25 +9,42 @@ Will not overwrite songs already in a playlist, so stuff like date added are kep
 XDGFX, 2020
 """
 
-import bz2
 import json
 import os
-import pickle
 import re
-import sqlite3
 import time
-from urllib.parse import urljoin
 
-import requests
 import spotipy
-from tqdm import tqdm
 
 from app import _ultrasonics
+# Renamed, as `database` holds the plugin settings inside run()
+from ultrasonics import database as ultrasonics_database
 from ultrasonics import logs
-from ultrasonics.tools import api_key, fuzzymatch, name_filter
+from ultrasonics.tools import (
+    disk_cache,
+    fuzzymatch,
+    name_filter,
+    parallel,
+    playlist_diff,
+    rate_limit,
+    spotify_token,
+)
 
 log = logs.create_log(__name__)
 
+# Seconds to cache search results for, and searches which found nothing
+search_cache_ttl = 30 * 24 * 60 * 60
+search_cache_negative_ttl = 24 * 60 * 60
+
+# Seconds to keep fetched playlist contents for
+playlist_store_ttl = 30 * 24 * 60 * 60
+
+# Maximum number of concurrent song searches for each playlist
+search_threads = 8
+
+# Maximum number of playlists fetched concurrently, each of which also fetches its pages concurrently
+playlist_threads = 4
+
 handshake = {
     "name": "spotify",
     "description": "sync your playlists to and from spotify",
@@ -79,124 +96,49 @@ def run(settings_dict, **kwargs):
     component = kwargs["component"]
     applet_id = kwargs["applet_id"]
     songs_dict = kwargs["songs_dict"]
+    context = kwargs.get("context")
 
     class Spotify:
         """
         Class for interactions with Spotify through the Spotipy api.
         """
 
-        def __init__(self):
-            self.cache_file = os.path.join(
-                _ultrasonics["config_dir"], "up_spotify", "up_spotify.bz2"
-            )
-
-            log.info(f"Credentials will be cached in: {self.cache_file}")
-
-            # Create the containing folder if it doesn't already exist
-            try:
-                os.mkdir(os.path.dirname(self.cache_file))
-            except FileExistsError:
-                # Folder already exists
-                pass
-
-        def token_get(self, force=False):
-            """
-            Updates the global access_token variable, in the following order of preference:
-            1. A locally saved access token.
-            2. Renews token using the database refresh_token.
-
-            If #2, the access token is saved to a .cache file.
-            """
-            log.debug("Fetching your Spotify token")
-            if os.path.isfile(self.cache_file) and not force:
-                with bz2.BZ2File(self.cache_file, "r") as f:
-                    raw = json.loads(pickle.load(f))
-                    token = raw["access_token"]
-
-                # Checks that the cached token is valid
-                if self.token_validate(token):
-                    log.debug("Returning cached token")
-                    return token
-
-            # In all other cases, renew the token
-            log.debug("Returning renewed token")
-            return self.token_renew()
-
-        def token_validate(self, token):
-            """
-            Checks if an auth token is valid, by making a request to the Spotify api.
-            """
-            url = f"https://api.spotify.com/v1/search"
-            params = {"q": "Flume", "type": "artist"}
-            headers = {"Authorization": f"Bearer {token}"}
-
-            resp = requests.get(url, headers=headers, params=params)
-
-            if resp.status_code == 200:
-                log.debug("Token is valid.")
-                return True
-
-            elif resp.status_code == 401:
-                log.debug("Token is not valid.")
-                return False
-
-            else:
-                log.error(f"Unexpected status code: {resp.status_code}")
-                raise Exception(resp.text)
-
-        def token_renew(self):
-            """
-            Using refresh_token, requests and saves a new access token.
-            """
-
-            url = urljoin(self.api_url, "spotify/auth/renew")
-            data = {
-                "refresh_token": self.refresh_token,
-                "ultrasonics_auth_hash": api_key.get_hash(True),
-            }
-
-            log.info("Requesting a new Spotify token, this may take a few seconds...")
-
-            # Request with a long timeout to account for free Heroku start-up 😉
-            resp = requests.post(url, data=data, timeout=60)
-
-            if resp.status_code == 200:
-                token = resp.json()["access_token"]
-
-                log.debug(
-                    f"Spotify renew data: {resp.text.replace(token, '***************')}"
-                )
-
-                with bz2.BZ2File(self.cache_file, "w") as f:
-                    pickle.dump(resp.text, f)
-
-                return token
-
-            else:
-                log.error(resp.text)
-                raise Exception(
-                    f"The response `when renewing Spotify token was unexpected: {resp.status_code}"
-                )
-
         def request(self, sp_func, *args, **kwargs):
             """
             Used to call a spotipy function, with automatic catching and renewing on access token errors.
             """
             errors = 0
+            rate_limited = 0
 
             while errors <= 1:
+                spotify_token.limiter.acquire()
+
                 try:
                     return sp_func(*args, **kwargs)
 
                 except spotipy.exceptions.SpotifyException as e:
-                    # Renew token
+                    # Rate limited, so all Spotify requests wait before trying again
+                    if e.http_status == 429 and rate_limited < 5:
+                        retry_after = rate_limit.retry_after(e.headers)
+                        log.warning(
+                            f"Spotify rate limit reached, waiting {retry_after} seconds.")
+
+                        spotify_token.limiter.penalise(retry_after)
+                        rate_limited += 1
+                        continue
+
                     log.error(e)
-                    self.sp = spotipy.Spotify(auth=self.token_get(force=True))
+
+                    # Renew token if it was rejected
+                    if e.http_status == 401:
+                        self.tokens.renew()
+
                     errors += 1
+                    error = e
                     continue
 
             log.error("An error occurred while trying to contact the Spotify api.")
-            raise Exception(e)
+            raise Exception(error)
 
         def search(self, track):
             """
@@ -279,11 +221,7 @@ def run(settings_dict, **kwargs):
 
             # Execute all queries
             for query in queries:
-                results = self.request(self.sp.search, query)
-
-                # Convert to ultrasonics format and append to results_list
-                for item in results["tracks"]["items"]:
-                    item = s.spotify_to_songs_dict(item)
+                for item in self.search_query(query):
                     if item not in results_list:
                         results_list.append(item)
 
@@ -306,27 +244,47 @@ def run(settings_dict, **kwargs):
 
             return spotify_uri, confidence
 
+        def search_query(self, query):
+            """
+            Search Spotify for tracks matching `query`, returning them in ultrasonics format.
+            Results are cached on disk (ISRC queries by ISRC), so repeated searches skip the api.
+            """
+            if query.startswith("isrc:"):
+                cache = isrc_cache
+                key = query[len("isrc:"):].strip().upper()
+            else:
+                cache = query_cache
+                key = " ".join(query.lower().split())
+
+            items = cache.get(key)
+
+            if items is disk_cache.missing:
+                results = self.request(self.sp.search, query)
+
+                items = [
+                    self.spotify_to_songs_dict(item) for item in results["tracks"]["items"]
+                ]
+
+                cache.set(key, items)
+
+            return items
+
         def current_user_playlists(self):
             """
             Wrapper for Spotify `current_user_playlists` which overcomes the request item limit.
+            The first page gives the total number of playlists, then all other pages are fetched concurrently.
             """
             limit = 50
-            playlists = self.request(
-                self.sp.current_user_playlists, limit=limit, offset=0
-            )["items"]
-
-            playlist_count = len(playlists)
-            i = 1
+            first = self.request(self.sp.current_user_playlists, limit=limit, offset=0)
 
-            # Get all playlists from the user
-            while playlist_count == limit:
-                buffer = self.request(
-                    self.sp.current_user_playlists, limit=limit, offset=limit * i
-                )["items"]
+            pages = parallel.map(
+                lambda offset: self.request(
+                    self.sp.current_user_playlists, limit=limit, offset=offset
+                )["items"],
+                range(limit, first["total"], limit),
+            )
 
-                playlists.extend(buffer)
-                playlist_count = len(buffer)
-                i += 1
+            playlists = first["items"] + [item for items in pages for item in items]
 
             log.info(f"Found {len(playlists)} playlist(s) on Spotify.")
 
@@ -335,8 +293,9 @@ def run(settings_dict, **kwargs):
         def current_user_saved_tracks(self, page=0):
             """
             Wrapper for Spotipy `current_user_saved_tracks`, which allows page selection to get earlier tracks.
+            Tracks are returned newest first.
             """
-            limit = 20
+            limit = 50
             offset = limit * page
 
             tracks = self.request(
@@ -347,48 +306,47 @@ def run(settings_dict, **kwargs):
 
             return spotify_ids, tracks
 
-        def playlist_tracks(self, playlist_id):
+        def playlist_tracks(self, playlist_id, snapshot_id=None):
             """
             Wrapper for Spotipy `playlist_tracks` which overcomes the request item limit.
+
+            If `snapshot_id` is supplied, tracks are served from the local playlist store when the playlist
+            hasn't changed since it was last fetched.
             """
-            limit = 100
-            fields = "items(track(album(name,release_date),artists,id,name,track_number,external_ids))"
-            tracks = self.request(
-                self.sp.playlist_tracks,
-                playlist_id,
-                limit=limit,
-                offset=0,
-                fields=fields,
-            )
+            if snapshot_id:
+                stored = playlist_store.get(playlist_id)
 
-            tracks = tracks["items"]
-            i = 1
+                if (
+                    stored is not disk_cache.missing
+                    and stored["snapshot_id"] == snapshot_id
+                ):
+                    log.debug(f"Playlist {playlist_id} is unchanged, using stored tracks")
+                    return stored["tracks"]
 
-            do_extend = len(tracks) == limit
+            limit = 100
+            fields = "total,items(track(album(name,release_date),artists,id,name,track_number,external_ids))"
 
-            # Get all tracks from the playlist
-            while do_extend:
-                buffer = self.request(
+            def page(offset):
+                return self.request(
                     self.sp.playlist_tracks,
                     playlist_id,
                     limit=limit,
-                    offset=limit * i,
+                    offset=offset,
                     fields=fields,
-                )["items"]
+                )
 
-                tracks.extend(buffer)
-                do_extend = len(buffer) == limit
+            # The first page gives the total number of tracks, then all other pages are fetched concurrently
+            first = page(0)
+            pages = parallel.map(page, range(limit, first["total"], limit))
 
-                i += 1
+            tracks = first["items"] + [
+                item for result in pages for item in result["items"]
+            ]
 
             track_list = []
 
             # Convert from Spotify API format to ultrasonics format
-            log.info("Converting tracks to ultrasonics format.")
-            for track in tqdm(
-                [track["track"] for track in tracks],
-                desc=f"Converting tracks in {playlist_id}",
-            ):
+            for track in [track["track"] for track in tracks]:
                 try:
                     track_list.append(s.spotify_to_songs_dict(track))
                 except TypeError:
@@ -397,18 +355,58 @@ def run(settings_dict, **kwargs):
                     )
                     continue
 
+            if snapshot_id:
+                playlist_store.set(
+                    playlist_id, {"snapshot_id": snapshot_id, "tracks": track_list}
+                )
+
             return track_list
 
-        def user_playlist_remove_all_occurrences_of_tracks(self, playlist_id, tracks):
+        def playlist_update(self, playlist_id, existing_uris, target_uris, snapshot_id):
             """
-            Wrapper for the spotipy function of the same name.
-            Removes all `tracks` from the specified playlist.
+            Update a playlist from `existing_uris` to `target_uris` with the fewest requests, by only removing,
+            moving, and adding the tracks which changed. Each request is made against the latest snapshot_id
+            of the playlist, so positions always refer to the expected playlist state.
             """
-            self.request(
-                self.sp.user_playlist_remove_all_occurrences_of_tracks,
-                self.user_id,
-                playlist_id,
-                tracks,
+            operations = playlist_diff.diff(existing_uris, target_uris)
+
+            for operation in operations:
+                if operation[0] == "remove":
+                    items = [
+                        {"uri": uri, "positions": positions}
+                        for uri, positions in operation[1]
+                    ]
+
+                    response = self.request(
+                        self.sp.playlist_remove_specific_occurrences_of_items,
+                        playlist_id,
+                        items,
+                        snapshot_id=snapshot_id,
+                    )
+
+                elif operation[0] == "move":
+                    _, range_start, range_length, insert_before = operation
+
+                    response = self.request(
+                        self.sp.playlist_reorder_items,
+                        playlist_id,
+                        range_start,
+                        insert_before,
+                        range_length=range_length,
+                        snapshot_id=snapshot_id,
+                    )
+
+                else:
+                    _, uris, position = operation
+
+                    response = self.request(
+                        self.sp.playlist_add_items, playlist_id, uris, position=position
+                    )
+
+                snapshot_id = response["snapshot_id"]
+
+            log.info(
+                f"Updated playlist {playlist_id} with {len(operations)} request(s)."
             )
 
         def spotify_to_songs_dict(self, track):
@@ -470,13 +468,35 @@ def run(settings_dict, **kwargs):
                 _ultrasonics["config_dir"], "up_spotify", "saved_songs.db"
             )
 
-            with sqlite3.connect(self.saved_songs_db) as conn:
+            # Create the containing folder if it doesn't already exist
+            try:
+                os.mkdir(os.path.dirname(self.saved_songs_db))
+            except FileExistsError:
+                # Folder already exists
+                pass
+
+            with ultrasonics_database.connect(self.saved_songs_db) as conn:
                 cursor = conn.cursor()
 
                 # Create saved songs table if needed
                 query = "CREATE TABLE IF NOT EXISTS saved_songs (applet_id TEXT, spotify_id TEXT)"
                 cursor.execute(query)
 
+                # Older versions could store the same song more than once, remove any repeats before indexing
+                query = "SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'saved_songs_applet_song'"
+                cursor.execute(query)
+
+                if not cursor.fetchone():
+                    query = "DELETE FROM saved_songs WHERE rowid NOT IN (SELECT MIN(rowid) FROM saved_songs GROUP BY applet_id, spotify_id)"
+                    cursor.execute(query)
+
+                    query = "CREATE UNIQUE INDEX saved_songs_applet_song ON saved_songs (applet_id, spotify_id)"
+                    cursor.execute(query)
+
+                # Create saved songs cursor table if needed, which holds the newest known added_at time
+                query = "CREATE TABLE IF NOT EXISTS saved_cursor (applet_id TEXT PRIMARY KEY, added_at TEXT)"
+                cursor.execute(query)
+
                 # Create lastrun table if needed
                 query = "CREATE TABLE IF NOT EXISTS lastrun (applet_id TEXT PRIMARY KEY, time INTEGER)"
                 cursor.execute(query)
@@ -487,7 +507,7 @@ def run(settings_dict, **kwargs):
             """
             Gets the last run time for saved songs mode.
             """
-            with sqlite3.connect(self.saved_songs_db) as conn:
+            with ultrasonics_database.connect(self.saved_songs_db) as conn:
                 cursor = conn.cursor()
 
                 query = "SELECT time FROM lastrun WHERE applet_id = ?"
@@ -501,40 +521,89 @@ def run(settings_dict, **kwargs):
             """
             Updates the last run time for saved songs mode.
             """
-            with sqlite3.connect(self.saved_songs_db) as conn:
+            with ultrasonics_database.connect(self.saved_songs_db) as conn:
                 cursor = conn.cursor()
 
                 query = "REPLACE INTO lastrun (time, applet_id) VALUES (?, ?)"
                 cursor.execute(query, (int(time.time()), applet_id))
 
-        def saved_songs_contains(self, spotify_id):
+        def saved_songs_known(self, spotify_ids):
             """
-            Checks if the input `spotify_id` is present in the saved songs database.
+            Checks which of the input `spotify_ids` are present in the saved songs database.
+
+            @return: set of the known spotify ids
             """
-            with sqlite3.connect(self.saved_songs_db) as conn:
+            with ultrasonics_database.connect(self.saved_songs_db) as conn:
                 cursor = conn.cursor()
 
-                query = "SELECT EXISTS(SELECT * FROM saved_songs WHERE applet_id = ? AND spotify_id = ?)"
-                cursor.execute(query, (applet_id, spotify_id))
+                query = f"SELECT spotify_id FROM saved_songs WHERE applet_id = ? AND spotify_id IN ({','.join('?' * len(spotify_ids))})"
+                cursor.execute(query, [applet_id] + list(spotify_ids))
 
-                rows = cursor.fetchone()
-
-                return rows[0]
+                return {row[0] for row in cursor.fetchall()}
 
         def saved_songs_add(self, spotify_ids):
             """
             Adds all songs in a list of `spotify_ids` to the saved songs database for this applet.
             """
-            with sqlite3.connect(self.saved_songs_db) as conn:
+            with ultrasonics_database.connect(self.saved_songs_db) as conn:
                 cursor = conn.cursor()
 
                 # Add saved songs to database
-                query = "INSERT INTO saved_songs (applet_id, spotify_id) VALUES (?, ?)"
+                query = "INSERT OR IGNORE INTO saved_songs (applet_id, spotify_id) VALUES (?, ?)"
                 values = [(applet_id, spotify_id) for spotify_id in spotify_ids]
                 cursor.executemany(query, values)
 
                 conn.commit()
 
+        def saved_cursor_get(self):
+            """
+            Gets the added_at time of the newest known saved song.
+            """
+            with ultrasonics_database.connect(self.saved_songs_db) as conn:
+                cursor = conn.cursor()
+
+                query = "SELECT added_at FROM saved_cursor WHERE applet_id = ?"
+                cursor.execute(query, (applet_id,))
+
+                rows = cursor.fetchone()
+
+                return None if not rows else rows[0]
+
+        def saved_cursor_set(self, added_at):
+            """
+            Updates the added_at time of the newest known saved song.
+            """
+            with ultrasonics_database.connect(self.saved_songs_db) as conn:
+                cursor = conn.cursor()
+
+                query = "REPLACE INTO saved_cursor (added_at, applet_id) VALUES (?, ?)"
+                cursor.execute(query, (added_at, applet_id))
+
+    # Search results are shared with the other Spotify plugin
+    search_cache_file = os.path.join(
+        _ultrasonics["config_dir"], "up_spotify", "search_cache.db"
+    )
+
+    isrc_cache = disk_cache.DiskCache(
+        search_cache_file,
+        "spotify_isrc",
+        ttl=search_cache_ttl,
+        negative_ttl=search_cache_negative_ttl,
+    )
+    query_cache = disk_cache.DiskCache(
+        search_cache_file,
+        "spotify_search",
+        ttl=search_cache_ttl,
+        negative_ttl=search_cache_negative_ttl,
+    )
+
+    # Playlist contents, keyed by playlist id and checked against the snapshot_id
+    playlist_store = disk_cache.DiskCache(
+        os.path.join(_ultrasonics["config_dir"], "up_spotify", "playlists.db"),
+        "spotify_playlists",
+        ttl=playlist_store_ttl,
+    )
+
     s = Spotify()
     db = Database()
 
@@ -543,7 +612,10 @@ def run(settings_dict, **kwargs):
     auth = json.loads(database["auth"])
     s.refresh_token = auth["refresh_token"]
 
-    s.sp = spotipy.Spotify(auth=s.token_get(), requests_timeout=60)
+    # Access tokens are renewed automatically before they expire
+    s.tokens = spotify_token.TokenManager(s.api_url, s.refresh_token)
+    s.sp = spotipy.Spotify(
+        auth_manager=s.tokens, requests_session=spotify_token.session(), requests_timeout=60)
 
     if component == "inputs":
         if settings_dict["mode"] == "playlists":
@@ -553,11 +625,14 @@ def run(settings_dict, **kwargs):
             playlists = s.current_user_playlists()
 
             songs_dict = []
+            snapshot_ids = {}
 
             for playlist in playlists:
                 if not isinstance(playlist, dict) or playlist.get("name") is None or playlist.get("id") is None:
                     continue
 
+                snapshot_ids[playlist["id"]] = playlist.get("snapshot_id")
+
                 item = {"name": playlist["name"], "id": {"spotify": playlist["id"]}}
 
                 songs_dict.append(item)
@@ -565,12 +640,21 @@ def run(settings_dict, **kwargs):
             # 2. Filter playlist titles
             songs_dict = name_filter.filter(songs_dict, settings_dict["filter"])
 
-            # 3. Fetch songs from each playlist, build songs_dict
+            # 3. Fetch songs from each playlist concurrently, build songs_dict
             log.info("Building songs_dict for playlists...")
-            for i, playlist in tqdm(enumerate(songs_dict)):
-                tracks = s.playlist_tracks(playlist["id"]["spotify"])
+            playlist_ids = [playlist["id"]["spotify"] for playlist in songs_dict]
+
+            tracks = parallel.map(
+                lambda playlist_id: s.playlist_tracks(
+                    playlist_id, snapshot_ids.get(playlist_id)
+                ),
+                playlist_ids,
+                threads=playlist_threads,
+                desc="Fetching playlists",
+            )
 
-                songs_dict[i]["songs"] = tracks
+            for playlist, playlist_tracks in zip(songs_dict, tracks):
+                playlist["songs"] = playlist_tracks
 
             return songs_dict
 
@@ -579,6 +663,10 @@ def run(settings_dict, **kwargs):
             if db.lastrun_get():
                 # Update songs
                 songs = []
+                new_ids = []
+
+                newest_known = db.saved_cursor_get()
+                newest = None
 
                 reached_limit = False
                 page = 0
@@ -587,15 +675,30 @@ def run(settings_dict, **kwargs):
                 while not reached_limit:
                     spotify_ids, tracks = s.current_user_saved_tracks(page=page)
 
+                    if not tracks:
+                        break
+
+                    newest = newest or tracks[0]["added_at"]
+                    known_ids = db.saved_songs_known(spotify_ids)
+
                     for spotify_id, track in zip(spotify_ids, tracks):
-                        if db.saved_songs_contains(spotify_id):
+                        if spotify_id in known_ids or (
+                            newest_known and track["added_at"] < newest_known
+                        ):
                             reached_limit = True
                             break
                         else:
                             songs.append(s.spotify_to_songs_dict(track["track"]))
+                            new_ids.append(spotify_id)
 
                     page += 1
 
+                # Remember new songs, so they aren't returned again on the next run
+                db.saved_songs_add(new_ids)
+
+                if newest:
+                    db.saved_cursor_set(newest)
+
                 if not songs:
                     log.info("No new saved songs were found. Exiting this applet.")
                     raise Exception("No new saved songs found on this applet run.")
@@ -620,11 +723,14 @@ def run(settings_dict, **kwargs):
                 )
 
                 # 1. Get some saved songs
-                spotify_ids, _ = s.current_user_saved_tracks()
+                spotify_ids, tracks = s.current_user_saved_tracks()
 
                 # 2. Update database with saved songs
                 db.saved_songs_add(spotify_ids)
 
+                if tracks:
+                    db.saved_cursor_set(tracks[0]["added_at"])
+
                 # 3. Update lastrun
                 db.lastrun_set()
 
@@ -640,8 +746,19 @@ def run(settings_dict, **kwargs):
 
         # Get a list of current user playlists
         current_playlists = s.current_user_playlists()
+        snapshot_ids = {
+            item["id"]: item.get("snapshot_id") for item in current_playlists
+        }
+
+        checkpoints = context.checkpoints if context else None
 
         for playlist in songs_dict:
+            # Skip playlists completed in a previous failed run
+            if checkpoints and checkpoints.playlist_done(playlist["name"]):
+                log.info(
+                    f"Playlist {playlist['name']} was already synced in a previous run, skipping.")
+                continue
+
             # Check the playlist already exists in Spotify
             playlist_id = ""
             try:
@@ -678,72 +795,82 @@ def run(settings_dict, **kwargs):
 
                 playlist_id = response["id"]
 
+            # Get all tracks already in the playlist
+            if playlist_id in snapshot_ids:
+                existing_tracks = s.playlist_tracks(
+                    playlist_id, snapshot_ids[playlist_id]
+                )
+            else:
                 existing_tracks = []
-                existing_uris = []
 
-            # Get all tracks already in the playlist
-            if "existing_tracks" not in vars():
-                existing_tracks = s.playlist_tracks(playlist_id)
-                existing_uris = [
-                    f"spotify:track:{item['id']['spotify']}" for item in existing_tracks
-                ]
+            # Existing tracks in playlist order, with None for tracks without a Spotify uri (e.g. local files)
+            existing_order = [
+                f"spotify:track:{item['id']['spotify']}"
+                if "spotify" in item.get("id", {})
+                else None
+                for item in existing_tracks
+            ]
+            existing_uris = set(existing_order) - {None}
 
-            # Add songs which don't already exist in the playlist
-            uris = []
-            duplicate_uris = []
+            # Spotify uri for each song in the playlist, by its position in the playlist
+            matches = {}
 
-            log.info("Searching for matching songs in Spotify.")
-            for song in tqdm(
-                playlist["songs"],
-                desc=f"Searching Spotify for songs from {playlist['name']}",
-            ):
-                # First check for fuzzy duplicate without Spotify api search
-                duplicate = False
-                for item in existing_tracks:
-                    score = fuzzymatch.similarity(song, item)
-
-                    if score > float(database.get("fuzzy_ratio") or 90):
-                        # Duplicate was found
-                        duplicate_uris.append(f"spotify:track:{item['id']['spotify']}")
-                        duplicate = True
-                        break
+            # First check for duplicates without Spotify api search, using an index of the existing tracks
+            fuzzy_ratio = float(database.get("fuzzy_ratio") or 90)
+            existing_index = fuzzymatch.SongIndex(existing_tracks)
+            search_songs = []
 
-                if duplicate:
-                    continue
+            for i, song in enumerate(playlist["songs"]):
+                item = existing_index.match(song, fuzzy_ratio)
 
-                uri, confidence = s.search(song)
+                if item and "spotify" in item.get("id", {}):
+                    matches[i] = f"spotify:track:{item['id']['spotify']}"
+                else:
+                    search_songs.append((i, song))
 
-                if uri in existing_uris:
-                    duplicate_uris.append(uri)
+            # Search for the remaining songs concurrently, keeping playlist order
+            log.info("Searching for matching songs in Spotify.")
+            results = parallel.map(
+                lambda item: s.search(item[1]),
+                search_songs,
+                threads=search_threads,
+                desc=f"Searching Spotify for songs from {playlist['name']}",
+            )
 
-                if confidence > float(database.get("fuzzy_ratio") or 90):
-                    uris.append(uri)
+            for (i, song), (uri, confidence) in zip(search_songs, results):
+                if confidence > fuzzy_ratio:
+                    matches[i] = uri
                 else:
                     log.debug(
                         f"Could not find song {song['title']} in Spotify; will not add to playlist."
                     )
 
-            if settings_dict["existing_playlists"] == "Update":
-                # Remove any songs which aren't in `uris` from the playlist
-                remove_uris = [
-                    uri for uri in existing_uris if uri not in uris + duplicate_uris
-                ]
-
-                s.user_playlist_remove_all_occurrences_of_tracks(
-                    playlist_id, remove_uris
-                )
+            # Target playlist, in order and without repeated tracks
+            target_uris = list(dict.fromkeys(matches[i] for i in sorted(matches)))
 
-            # Add tracks to playlist in batches of 100
-            while len(uris) > 100:
-                s.request(
-                    s.sp.user_playlist_add_tracks, s.user_id, playlist_id, uris[0:100]
+            if settings_dict["existing_playlists"] == "Update":
+                # Make the playlist match the target, touching only tracks which changed
+                s.playlist_update(
+                    playlist_id,
+                    existing_order,
+                    target_uris,
+                    snapshot_ids.get(playlist_id),
                 )
 
-                uris = uris[100:]
+            else:
+                # Add songs which don't already exist in the playlist, in batches of 100
+                uris = [uri for uri in target_uris if uri not in existing_uris]
+
+                for i in range(0, len(uris), 100):
+                    s.request(
+                        s.sp.user_playlist_add_tracks,
+                        s.user_id,
+                        playlist_id,
+                        uris[i : i + 100],
+                    )
 
-            # Add all remaining tracks
-            if uris:
-                s.request(s.sp.user_playlist_add_tracks, s.user_id, playlist_id, uris)
+            if checkpoints:
+                checkpoints.playlist_completed(playlist["name"])
 
 
 def builder(**kwargs):
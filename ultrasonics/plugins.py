@@ -7,13 +7,17 @@ Handles all functions for interacting with plugins and applets.
 XDGFX, 2020
 """
 
+import hashlib
 import importlib
 import json
 import os
 import re
+from contextlib import nullcontext
 from itertools import chain
 
-from ultrasonics import database, logs, scheduler
+from ultrasonics import database, logs, metrics, profiler, scheduler
+from ultrasonics.checkpoints import Checkpoints
+from ultrasonics.context import RunContext
 
 log = logs.create_log(__name__)
 
@@ -142,7 +146,7 @@ def plugin_update(name, version, settings):
     dbp.set(name, version, settings)
 
 
-def plugin_run(name, version, settings_dict, component=None, applet_id=None, songs_dict=None):
+def plugin_run(name, version, settings_dict, component=None, applet_id=None, songs_dict=None, context=None):
     """
     Run a specific plugin.
 
@@ -151,20 +155,51 @@ def plugin_run(name, version, settings_dict, component=None, applet_id=None, son
     version:         version of plugin
     settings_dict:   settings to run this specific instance of the plugin, taken from the applet
     songs_dict:      passed to the plugin if not an input
+    context:         RunContext for the applet run, if None settings are loaded from the database
 
     OUTPUTS
     response:        either a success message, or the new songs_dict
     """
     log.debug(f"Running plugin {name} v{version}")
-    plugin_settings = dbp.get(name, version)
-    global_settings = dbc.load(raw=True)
 
-    response = found_plugins[name].run(
-        settings_dict, database=plugin_settings, global_settings=global_settings, component=component, applet_id=applet_id, songs_dict=songs_dict)
+    if context:
+        plugin_settings = context.settings(name, version)
+        global_settings = context.global_settings
+    else:
+        plugin_settings = dbp.get(name, version)
+        global_settings = dbc.load(raw=True)
+
+    if context and context.profile:
+        run_profile = profiler.profile(name, version, component, applet_id)
+    else:
+        run_profile = nullcontext()
+
+    try:
+        with run_profile, metrics.plugin_run_seconds.time(plugin=name, component=component):
+            response = found_plugins[name].run(
+                settings_dict, database=plugin_settings, global_settings=global_settings, component=component, applet_id=applet_id, songs_dict=songs_dict, context=context)
+
+    except Exception:
+        metrics.plugin_failures.inc(plugin=name, component=component)
+        raise
 
     return response
 
 
+def plugin_deterministic(name, settings_dict):
+    """
+    Check if a plugin always gives the same result for the same songs_dict and settings.
+    Plugins which don't (e.g. random mixes) can define a `deterministic` function, taking the applet settings
+    for the plugin and returning False. Plugins without one are assumed to be deterministic.
+    """
+    deterministic = getattr(found_plugins[name], "deterministic", None)
+
+    if deterministic is None:
+        return True
+
+    return deterministic(settings_dict)
+
+
 def plugin_test(name, version, database=None, component=None):
     """
     Get the test function from a specified plugin.
@@ -240,9 +275,24 @@ def applet_delete(applet_id):
     dba.remove(applet_id)
 
 
-def applet_run(applet_id):
+def fingerprint(data):
+    """
+    Create a content fingerprint of any json serialisable data, such as applet plans or a songs_dict.
+    """
+    data_string = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(data_string.encode()).hexdigest()
+
+
+def applet_run(applet_id, context=None):
     """
     Run the requested applet in full.
+    If a RunContext is not supplied, one is built from the database.
+
+    If the songs_dict from the inputs and the applet plans are unchanged since the last successful run,
+    modifiers and outputs are skipped, unless the applet is set to always run in full or uses a modifier which
+    isn't deterministic.
+
+    If the previous run failed, this run resumes from its last checkpoint where possible.
     """
     from datetime import datetime
 
@@ -250,8 +300,11 @@ def applet_run(applet_id):
 
     log.info(f"Running applet: {applet_id}")
 
+    skipped = False
+
     try:
-        applet_plans = dba.get(applet_id)
+        context = context or RunContext(applet_id)
+        applet_plans = context.applet_plans
 
         if not applet_plans["inputs"] or not applet_plans["outputs"]:
             raise Exception(
@@ -267,23 +320,85 @@ def applet_run(applet_id):
 
                 return name, version, data
 
-            "Inputs"
-            # Get new songs from input, append to songs list
-            for plugin in applet_plans["inputs"]:
-                for item in plugin_run(*get_info(plugin), component="inputs", applet_id=applet_id):
-                    songs_dict.append(item)
-
-            "Modifiers"
-            # Replace songs with output from modifier plugin
-            for plugin in applet_plans["modifiers"]:
-                songs_dict = plugin_run(
-                    *get_info(plugin), songs_dict=songs_dict, component="modifiers", applet_id=applet_id)
-
-            "Outputs"
-            # Submit songs dict to output plugin
-            for plugin in applet_plans["outputs"]:
-                plugin_run(*get_info(plugin), component="outputs",
-                           applet_id=applet_id, songs_dict=songs_dict)
+            # Ignore plans which don't affect the result
+            plans_fingerprint = fingerprint(
+                {key: value for key, value in applet_plans.items() if key not in ["applet_name", "profile", "force_run"]})
+
+            # Load checkpoints from a previous failed run, if they are fresh enough
+            freshness = int(context.global_settings.get(
+                "checkpoint_freshness") or 0) * 60
+            checkpoints = Checkpoints(applet_id, plans_fingerprint, freshness)
+            context.checkpoints = checkpoints
+
+            resume = checkpoints.load(
+                "modifiers") or checkpoints.load("inputs")
+
+            if resume:
+                log.info(
+                    f"Resuming applet {applet_id} from the checkpoint of a previous failed run.")
+                songs_dict = resume["songs_dict"]
+                songs_fingerprint = resume["songs_fingerprint"]
+
+            else:
+                # Any progress left from a previous attempt applies to different songs
+                checkpoints.clear()
+
+                "Inputs"
+                # Get new songs from input, append to songs list
+                for plugin in applet_plans["inputs"]:
+                    for item in plugin_run(*get_info(plugin), component="inputs", applet_id=applet_id, context=context):
+                        songs_dict.append(item)
+
+                # Fingerprint inputs before modifiers can change them
+                songs_fingerprint = fingerprint(songs_dict)
+                checkpoints.songs_fingerprint = songs_fingerprint
+
+                checkpoints.save("inputs", {
+                    "songs_dict": songs_dict,
+                    "songs_fingerprint": songs_fingerprint
+                })
+
+            # Modifiers which give a different result every run can't be skipped
+            deterministic = all(plugin_deterministic(plugin["plugin"], plugin["data"])
+                                for plugin in applet_plans["modifiers"])
+
+            if not applet_plans.get("force_run") and deterministic and dba.fingerprint_get(applet_id) == (plans_fingerprint, songs_fingerprint):
+                log.info(
+                    f"Inputs for applet {applet_id} are unchanged since the last successful run, skipping modifiers and outputs.")
+                skipped = True
+
+            else:
+                if not checkpoints.load("modifiers") and applet_plans["modifiers"]:
+                    "Modifiers"
+                    # Replace songs with output from modifier plugin
+                    for plugin in applet_plans["modifiers"]:
+                        songs_dict = plugin_run(
+                            *get_info(plugin), songs_dict=songs_dict, component="modifiers", applet_id=applet_id, context=context)
+
+                    checkpoints.save("modifiers", {
+                        "songs_dict": songs_dict,
+                        "songs_fingerprint": songs_fingerprint
+                    })
+
+                "Outputs"
+                # Submit songs dict to output plugin, skipping any completed in a previous failed run
+                for i, plugin in enumerate(applet_plans["outputs"]):
+                    if checkpoints.output_done(i):
+                        log.info(
+                            f"Output {plugin['plugin']} already completed in a previous run, skipping.")
+                        continue
+
+                    checkpoints.output = i
+
+                    plugin_run(*get_info(plugin), component="outputs",
+                               applet_id=applet_id, songs_dict=songs_dict, context=context)
+
+                    checkpoints.output_completed(i)
+
+                dba.fingerprint_set(
+                    applet_id, plans_fingerprint, songs_fingerprint)
+
+            checkpoints.clear()
 
             success = True
 
@@ -292,6 +407,15 @@ def applet_run(applet_id):
 
         success = False
 
+    finally:
+        if context:
+            context.close()
+
+    metrics.applet_runs.inc(
+        result="skipped" if skipped else "success" if success else "failure")
+    metrics.applet_run_seconds.observe(
+        (datetime.now() - runtime).total_seconds())
+
     if success:
         log.info(
             f"Applet {applet_id} completed successfully in {datetime.now() - runtime}")
@@ -301,7 +425,8 @@ def applet_run(applet_id):
 
     lastrun = {
         "time": runtime.strftime("%d-%m-%Y %H:%M"),
-        "result": success
+        "result": success,
+        "skipped": skipped
     }
 
     dba.lastrun(applet_id, lastrun)
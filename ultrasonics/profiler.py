@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+"""
+profiler
+Opt-in profiling of plugin runs.
+
+When enabled (globally, or for a single applet), every plugin run is wrapped with:
+    - Wall and CPU timers
+    - A cProfile trace, saved as <profile_id>.prof (readable with pstats, snakeviz, flameprof...)
+    - A stack sampler, saved as <profile_id>.folded (collapsed stacks for flamegraph.pl, speedscope...)
+    - tracemalloc, recording peak memory allocated during the run
+    - Counters for HTTP requests (per host) and SQLite queries
+
+Work done in worker threads (see tools/parallel) is included too: each worker task is traced with its own
+cProfile, merged into the run's trace when saved, its stacks are sampled, and its CPU time is added to the
+run's CPU time.
+
+A summary of each run is stored in the ultrasonics database, and traces are saved in `profiles_dir`.
+
+XDGFX, 2020
+"""
+
+import contextvars
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+from ultrasonics import logs, metrics
+
+log = logs.create_log(__name__)
+
+profiles_dir = "config/profiles"
+
+# Maximum number of profiles to keep, oldest are removed first
+profiles_limit = 200
+
+# Seconds between each stack sample
+sample_interval = 0.005
+
+# The profile for the plugin run currently executing in this context
+current = contextvars.ContextVar("profile", default=None)
+
+# tracemalloc is process-wide, so only stop it once no profiles are running
+tracemalloc_users = 0
+tracemalloc_lock = threading.Lock()
+
+
+def enabled(global_settings, applet_plans=None):
+    """
+    Check if plugin runs should be profiled, either for all applets or for the supplied applet.
+    """
+    if global_settings.get("profiling") == "Yes":
+        return True
+
+    return bool(applet_plans and applet_plans.get("profile"))
+
+
+class Profile:
+    """
+    Collects profiling data for a single plugin run.
+    """
+
+    def __init__(self, name, version, component, applet_id):
+        self.profile_id = str(uuid.uuid4())
+
+        self.summary = {
+            "plugin": name,
+            "version": version,
+            "component": component,
+            "applet_id": applet_id,
+            "time": time.time()
+        }
+
+        self.http = Counter()
+        self.queries = 0
+        self.query_time = 0
+        self.stacks = Counter()
+
+        # Threads whose stacks are sampled, and traces and CPU time from finished worker tasks
+        self.threads = set()
+        self.worker_profilers = []
+        self.worker_cpu_time = 0
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        """
+        Start all timers and traces, from the thread running the plugin.
+        """
+        global tracemalloc_users
+
+        with tracemalloc_lock:
+            if tracemalloc_users == 0:
+                tracemalloc.start()
+            tracemalloc_users += 1
+
+        self.memory_baseline = tracemalloc.get_traced_memory()[0]
+
+        # Sample stacks of the thread running the plugin, and any worker threads it starts
+        self.threads.add(threading.get_ident())
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+        self.profiler = cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            log.warning("Could not start cProfile, only timings will be saved.")
+            self.profiler = None
+
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+
+    def stop(self):
+        """
+        Stop all timers and traces, and build the run summary.
+        """
+        global tracemalloc_users
+
+        cpu_time = time.thread_time() - self.cpu_start
+        wall_time = time.perf_counter() - self.wall_start
+
+        if self.profiler:
+            self.profiler.disable()
+
+        self.stopped.set()
+        self.sampler.join()
+
+        peak_memory = tracemalloc.get_traced_memory()[1] - self.memory_baseline
+
+        with tracemalloc_lock:
+            tracemalloc_users -= 1
+            if tracemalloc_users == 0:
+                tracemalloc.stop()
+
+        self.summary.update({
+            "wall_time": round(wall_time, 3),
+            "cpu_time": round(cpu_time + self.worker_cpu_time, 3),
+            "peak_memory": max(peak_memory, 0),
+            "http_requests": dict(self.http),
+            "http_total": sum(self.http.values()),
+            "sql_queries": self.queries,
+            "sql_time": round(self.query_time, 3),
+            "files": ["prof"] * bool(self.profiler) + ["folded"]
+        })
+
+    def sample(self):
+        """
+        Record the call stack of every profiled thread every `sample_interval` until stopped.
+        """
+        while not self.stopped.wait(sample_interval):
+            frames = sys._current_frames()
+
+            with self.lock:
+                threads = list(self.threads)
+
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    @contextmanager
+    def worker(self):
+        """
+        Profile a task running in a worker thread, as part of this run.
+        """
+        thread_id = threading.get_ident()
+
+        with self.lock:
+            self.threads.add(thread_id)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            profiler = None
+
+        cpu_start = time.thread_time()
+
+        try:
+            yield
+
+        finally:
+            cpu_time = time.thread_time() - cpu_start
+
+            if profiler:
+                profiler.disable()
+
+            with self.lock:
+                self.threads.discard(thread_id)
+                self.worker_cpu_time += cpu_time
+
+                if profiler:
+                    self.worker_profilers.append(profiler)
+
+    def save(self):
+        """
+        Write traces to the profiles directory, and the summary to the database.
+        """
+        from ultrasonics import database
+
+        os.makedirs(profiles_dir, exist_ok=True)
+
+        path = os.path.join(profiles_dir, self.profile_id)
+
+        if self.profiler:
+            # Merge the traces of worker tasks into the run's trace
+            stats = pstats.Stats(self.profiler)
+            for profiler in self.worker_profilers:
+                stats.add(profiler)
+
+            stats.dump_stats(path + ".prof")
+
+        with open(path + ".folded", "w") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+        db = database.Profile()
+        db.add(self.profile_id, self.summary["applet_id"], self.summary)
+
+        # Remove old profiles
+        for profile_id in db.prune(profiles_limit):
+            for ext in [".prof", ".folded"]:
+                try:
+                    os.remove(os.path.join(profiles_dir, profile_id + ext))
+                except FileNotFoundError:
+                    pass
+
+        log.info(
+            f"Profiled {self.summary['plugin']} in {self.summary['wall_time']}s: {self.profile_id}")
+
+
+@contextmanager
+def profile(name, version, component=None, applet_id=None):
+    """
+    Profile everything run inside this context manager, saving the results on exit.
+    """
+    run = Profile(name, version, component, applet_id)
+    token = current.set(run)
+
+    run.start()
+
+    try:
+        yield run
+
+    except Exception as e:
+        run.summary["error"] = repr(e)
+        raise
+
+    finally:
+        run.stop()
+        current.reset(token)
+
+        try:
+            run.save()
+        except Exception as e:
+            log.error("Could not save profile.")
+            log.error(e, exc_info=True)
+
+
+@contextmanager
+def worker():
+    """
+    Include a task running in a worker thread in the current profile, if any.
+    Context variables must already be copied into the worker thread.
+    """
+    run = current.get()
+
+    if run:
+        with run.worker():
+            yield
+    else:
+        yield
+
+
+def track_request(host, status, elapsed):
+    """
+    Record an HTTP request against the current profile, if any.
+    """
+    run = current.get()
+
+    if run:
+        with run.lock:
+            run.http[f"{host} {status}"] += 1
+
+
+def track_query(elapsed):
+    """
+    Record an SQLite query against the current profile, if any.
+    """
+    run = current.get()
+
+    if run:
+        with run.lock:
+            run.queries += 1
+            run.query_time += elapsed
+
+
+# Track every request made through the requests library, including those made by spotipy and plexapi.
+session_send = requests.Session.send
+
+
+def tracked_send(self, request, **kwargs):
+    start = time.perf_counter()
+    status = None
+
+    try:
+        response = session_send(self, request, **kwargs)
+        status = response.status_code
+        return response
+
+    finally:
+        host = urlparse(request.url).hostname
+        elapsed = time.perf_counter() - start
+
+        track_request(host, status, elapsed)
+        metrics.http_requests.inc(host=host, status=status or "error")
+        metrics.http_request_seconds.observe(elapsed, host=host)
+
+
+requests.Session.send = tracked_send
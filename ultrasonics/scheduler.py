@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
+import threading
 import time
 from concurrent import futures
 
-from ultrasonics import database, logs, plugins
+from ultrasonics import database, logs, metrics, plugins
+from ultrasonics.context import RunContext
 
 log = logs.create_log(__name__)
 
@@ -11,6 +13,43 @@ log = logs.create_log(__name__)
 applets_running = {}
 pool = futures.ThreadPoolExecutor(max_workers=256)
 
+# Number of submitted tasks waiting for a thread, and currently running
+tasks = {"queued": 0, "active": 0}
+tasks_lock = threading.Lock()
+
+metrics.Gauge("ultrasonics_scheduler_queue_depth",
+              "Tasks waiting for a free thread in the scheduler pool.", lambda: tasks["queued"])
+metrics.Gauge("ultrasonics_scheduler_threads",
+              "Threads in the scheduler pool currently running a task.", lambda: tasks["active"])
+metrics.Gauge("ultrasonics_scheduler_applets",
+              "Applets currently scheduled.", lambda: sum(applets_running.values()))
+
+
+def submit(func, *args, **kwargs):
+    """
+    Submit a task to the scheduler pool, counting it as queued until it starts, then active until it ends.
+    """
+    def task():
+        with tasks_lock:
+            tasks["queued"] -= 1
+            tasks["active"] += 1
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with tasks_lock:
+                tasks["active"] -= 1
+
+    with tasks_lock:
+        tasks["queued"] += 1
+
+    try:
+        return pool.submit(task)
+    except Exception:
+        with tasks_lock:
+            tasks["queued"] -= 1
+        raise
+
 
 def scheduler_start():
     """
@@ -31,10 +70,10 @@ def applet_submit(applet_id):
         applets_running[applet_id] = False
 
         # Resubmit with a delay to allow the applet to exit
-        pool.submit(scheduler_applet_loop, applet_id,
+        submit(scheduler_applet_loop, applet_id,
                     delay=trigger_poll())
     else:
-        pool.submit(scheduler_applet_loop, applet_id)
+        submit(scheduler_applet_loop, applet_id)
 
 
 def scheduler_applet_loop(applet_id, delay=0):
@@ -59,7 +98,7 @@ def scheduler_applet_loop(applet_id, delay=0):
 
     while True:
         # Create new thread for timer plugin
-        trigger_thread = pool.submit(
+        trigger_thread = submit(
             ExecThread, applet_id)
 
         # Wait for trigger to complete
@@ -74,9 +113,18 @@ def scheduler_applet_loop(applet_id, delay=0):
         if trigger_thread.result():
             break
 
-        # Check if applet still exists in the database
-        if database.Applet().get(applet_id) is not None:
-            plugins.applet_run(applet_id)
+        # Check if applet still exists in the database, taking a snapshot for the run
+        try:
+            context = RunContext(applet_id)
+        except Exception as e:
+            # Skip this run, but keep the applet scheduled
+            log.error(
+                f"Could not load applet {applet_id} from the database, skipping this run.")
+            log.error(e, exc_info=True)
+            continue
+
+        if context.exists():
+            plugins.applet_run(applet_id, context=context)
         else:
             break
 
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+sessions
+Shared http sessions, used by plugins to talk to external services.
+
+Sessions are created once per host and kept for the life of ultrasonics, so connections (and TLS handshakes)
+are reused between requests, plugin runs, and applets. Each session has a sized connection pool, a default
+timeout, and asks for gzip compressed responses.
+
+Plugins should use `sessions.get(url)` instead of calling `requests.get/post` directly.
+
+XDGFX, 2020
+"""
+
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ultrasonics import logs, metrics
+
+log = logs.create_log(__name__)
+
+# Maximum number of connections kept open to each host
+pool_size = 16
+
+# Timeout (seconds) used for requests which don't set their own
+default_timeout = 30
+
+sessions = {}
+lock = threading.Lock()
+
+metrics.Gauge("ultrasonics_http_sessions",
+              "Shared http sessions currently open.", lambda: len(sessions))
+
+
+class Session(requests.Session):
+    """
+    A requests session which applies a default timeout, and can't be closed by the code using it.
+
+    Some libraries (e.g. spotipy) close the session they are given once they are finished with it, which
+    would throw away the connection pool shared with everything else.
+    """
+
+    def __init__(self, timeout=default_timeout, retries=0):
+        super().__init__()
+
+        self.timeout = timeout
+        self.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size, max_retries=retries)
+
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+
+        return super().request(method, url, **kwargs)
+
+    def close(self):
+        # Sessions are owned by the core, and are closed with `close_all`
+        pass
+
+
+def get(url, timeout=default_timeout, retries=0):
+    """
+    Get the shared session for the host in `url`, creating it if needed.
+
+    `timeout` and `retries` (see urllib3 `Retry`) are only used when the session is first created.
+    """
+    parsed = urlparse(url)
+    key = f"{parsed.scheme or 'https'}://{parsed.netloc or parsed.path}"
+
+    with lock:
+        if key not in sessions:
+            log.debug(f"Creating http session for: {key}")
+            sessions[key] = Session(timeout=timeout, retries=retries)
+
+        return sessions[key]
+
+
+def close_all():
+    """
+    Close every shared session, and their connections.
+    """
+    with lock:
+        for session in sessions.values():
+            requests.Session.close(session)
+
+        sessions.clear()
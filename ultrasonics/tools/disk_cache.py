@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+disk_cache
+Persistent key-value caches, stored in sqlite databases inside plugin config folders.
+
+Values are stored as JSON, and expire after `ttl` seconds. Empty values (e.g. no search results) are cached
+as misses, which expire sooner after `negative_ttl` seconds. Once a cache holds more than `max_entries`
+entries, the oldest are evicted.
+
+Every lookup is recorded in the cache metrics, under the cache `name`.
+
+XDGFX, 2020
+"""
+
+import json
+import os
+import threading
+import time
+
+from ultrasonics import database, logs, metrics
+
+log = logs.create_log(__name__)
+
+# Returned by `get` when a key is not cached, as None and empty values can be cached
+missing = object()
+
+# Number of writes between each eviction check
+evict_interval = 500
+
+
+class DiskCache:
+    """
+    A single cache table, inside the sqlite database at `path`.
+    """
+
+    def __init__(self, path, name, ttl, negative_ttl=None, max_entries=50000):
+        self.path = path
+        self.name = name
+        self.table = name.replace("-", "_")
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_entries = max_entries
+
+        self.writes = 0
+        self.lock = threading.Lock()
+
+        # Create the containing folder if it doesn't already exist
+        try:
+            os.makedirs(os.path.dirname(path))
+        except FileExistsError:
+            # Folder already exists
+            pass
+
+        with database.connect(self.path) as conn:
+            cursor = conn.cursor()
+
+            query = f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT, time REAL, expires REAL)"
+            cursor.execute(query)
+
+            query = f"CREATE INDEX IF NOT EXISTS {self.table}_time ON {self.table} (time)"
+            cursor.execute(query)
+
+            conn.commit()
+
+        self.evict()
+
+    def get(self, key, default=missing):
+        """
+        Get the cached value for `key`, or `default` if it isn't cached or has expired.
+        """
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """
+        Get cached values for many keys at once. Returns a dict containing only the keys which were found.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+
+        with database.connect(self.path) as conn:
+            cursor = conn.cursor()
+
+            # Stay well below the sqlite variable limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+
+                query = f"SELECT key, value FROM {self.table} WHERE expires > ? AND key IN ({','.join('?' * len(batch))})"
+                cursor.execute(query, [time.time()] + batch)
+
+                found.update({key: json.loads(value)
+                              for key, value in cursor.fetchall()})
+
+        for key in keys:
+            metrics.cache_access(self.name, key in found)
+
+        return found
+
+    def set(self, key, value):
+        """
+        Cache `value` for `key`. Empty values are cached with the negative ttl.
+        """
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """
+        Cache many values at once, from a dict of {key: value}.
+        """
+        now = time.time()
+
+        values = [
+            (key, json.dumps(value, default=str), now,
+             now + (self.ttl if value else self.negative_ttl))
+            for key, value in items.items()
+        ]
+
+        with database.connect(self.path) as conn:
+            cursor = conn.cursor()
+
+            query = f"REPLACE INTO {self.table} (key, value, time, expires) VALUES (?, ?, ?, ?)"
+            cursor.executemany(query, values)
+
+            conn.commit()
+
+        with self.lock:
+            self.writes += len(values)
+            evict = self.writes >= evict_interval
+
+            if evict:
+                self.writes = 0
+
+        if evict:
+            self.evict()
+
+    def remove(self, key):
+        """
+        Remove `key` from the cache.
+        """
+        with database.connect(self.path) as conn:
+            cursor = conn.cursor()
+
+            query = f"DELETE FROM {self.table} WHERE key = ?"
+            cursor.execute(query, (key,))
+
+            conn.commit()
+
+    def evict(self):
+        """
+        Remove expired entries, and the oldest entries if there are more than `max_entries`.
+        """
+        with database.connect(self.path) as conn:
+            cursor = conn.cursor()
+
+            query = f"DELETE FROM {self.table} WHERE expires <= ?"
+            cursor.execute(query, (time.time(),))
+
+            query = f"SELECT COUNT(*) FROM {self.table}"
+            cursor.execute(query)
+            excess = cursor.fetchone()[0] - self.max_entries
+
+            if excess > 0:
+                log.debug(
+                    f"Evicting {excess} entries from cache: {self.name}")
+
+                query = f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY time LIMIT ?)"
+                cursor.execute(query, (excess,))
+
+            conn.commit()
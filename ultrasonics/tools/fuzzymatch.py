@@ -16,6 +16,8 @@ returning True if one is found. The weighting for each song field is:
 
 It goes without saying that inaccurate music tags (such as from local files) may produce inaccurate results.
 
+To match many songs against the same (large) list, build a `SongIndex` of the list once.
+
 XDGFX, 2020
 """
 
@@ -222,3 +224,110 @@ def similarity(a, b):
     total_score = total_score * 100 / corrector
 
     return total_score
+
+
+class SongIndex:
+    """
+    Index of a song list, used to find matches for many songs without comparing each one against the whole
+    list.
+
+    Exact matches are looked up by location, service id, and ISRC. Fuzzy matching with `similarity` is only
+    used against songs sharing at least one word of their (cleaned) title, and whose title is similar enough
+    that the song could pass the threshold.
+    """
+
+    def __init__(self, songs):
+        self.songs = list(songs)
+        self.titles = [self.clean_title(song) for song in self.songs]
+
+        self.exact = {}
+        self.words = {}
+        self.untitled = []
+
+        for position, song in enumerate(self.songs):
+            for key in self.exact_keys(song):
+                self.exact.setdefault(key, position)
+
+            words = set(re.findall(r"\w+", self.titles[position] or ""))
+
+            if not words:
+                self.untitled.append(position)
+
+            for word in words:
+                self.words.setdefault(word, []).append(position)
+
+    @staticmethod
+    def exact_keys(song):
+        """
+        Keys which identify a song exactly.
+        """
+        keys = []
+
+        if song.get("location"):
+            keys.append(("location", song["location"]))
+
+        for service, value in (song.get("id") or {}).items():
+            if value:
+                keys.append((service, str(value).strip()))
+
+        if song.get("isrc"):
+            keys.append(("isrc", song["isrc"].strip().lower()))
+
+        return keys
+
+    @staticmethod
+    def clean_title(song):
+        """
+        Lowercase song title without features and production credits, as compared by `similarity`.
+        """
+        try:
+            title = re.sub(cutoff_regex[0], "",
+                           song["title"], flags=re.IGNORECASE) + "\n"
+            return re.sub(cutoff_regex[1], " ",
+                          title, flags=re.IGNORECASE).strip().lower()
+        except (KeyError, TypeError):
+            return None
+
+    def match(self, song, threshold):
+        """
+        Find the song in the index which best matches `song`, with a similarity above `threshold`.
+
+        @return: the matching song, or None if there isn't one.
+        """
+        for key in self.exact_keys(song):
+            if key in self.exact:
+                return self.songs[self.exact[key]]
+
+        threshold = float(threshold)
+        title = self.clean_title(song)
+        words = set(re.findall(r"\w+", title or ""))
+
+        if words:
+            candidates = {position for word in words
+                          for position in self.words.get(word, [])}
+            candidates.update(self.untitled)
+        else:
+            candidates = range(len(self.songs))
+
+        # With both titles present, other fields can add at most 11 parts to the 8 parts title score (out
+        # of 19), so titles less similar than this can't pass the threshold
+        min_title_ratio = (19 * threshold - 1100) / 8
+
+        best = None
+        best_score = threshold
+
+        for position in sorted(candidates):
+            if title and self.titles[position]:
+                if fuzz.ratio(title, self.titles[position]) <= min_title_ratio:
+                    continue
+
+            score = similarity(song, self.songs[position])
+
+            if score > best_score:
+                best = self.songs[position]
+                best_score = score
+
+                if score >= 100:
+                    break
+
+        return best
@@ -6,20 +6,22 @@ Fetches tags from local music files.
 
 Given an input path, the metadata tags will be returned in standard ultrasonics songlist format.
 This is done either by reading directly from the song file, or by reading from a cache if the song has not been modified since last read.
+The tag cache is shared by every plugin, and each entry is checked against the file's modified time.
 The currently supported audio formats are shown in supported_audio_extensions.
 
 XDGFX, 2020
 """
 
-import hashlib
 import os
-# import sqlite3
+import threading
 
 from mutagen.easyid3 import EasyID3
 from mutagen.mp4 import MP4
 from mutagen.flac import FLAC
 
+from app import _ultrasonics
 from ultrasonics import logs
+from ultrasonics.tools import disk_cache
 
 log = logs.create_log(__name__)
 
@@ -29,22 +31,29 @@ supported_audio_extensions = [
     ".flac"    
 ]
 
-# db_file = os.path.join(os.path.dirname(__file__), "local_tags.db")
+cache_file = os.path.join(
+    _ultrasonics["config_dir"], "local_tags", "local_tags.db")
 
-# log.debug("Loaded local_tags tool. Initialising database...")
+# Seconds to keep cached tags for, and the most files to keep cached tags for
+cache_ttl = 180 * 24 * 60 * 60
+cache_max_entries = 200000
 
-# with sqlite3.connect(db_file) as conn:
-#     cursor = conn.cursor()
+cache = None
+cache_lock = threading.Lock()
 
-#     try:
-#         # Create tracks table if needed
-#         query = "CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, checksum TEXT, tags TEXT)"
-#         cursor.execute(query)
 
-#         conn.commit()
+def get_cache():
+    """
+    Get the shared tag cache, creating it the first time it is used.
+    """
+    global cache
 
-#     except sqlite3.Error as e:
-#         log.info("Error while initialising local_tags database", e)
+    with cache_lock:
+        if cache is None:
+            cache = disk_cache.DiskCache(
+                cache_file, "local_tags", ttl=cache_ttl, max_entries=cache_max_entries)
+
+        return cache
 
 
 def tags(song_path):
@@ -56,26 +65,13 @@ def tags(song_path):
     if ext.lower() not in supported_audio_extensions:
         raise NotImplementedError(song_path)
 
-    # song_mtime = os.stat(song_path).st_mtime
-
-    # # First try to load tags from the database for speed
-    # with sqlite3.connect(db_file) as conn:
-    #     try:
-    #         cursor = conn.cursor()
+    song_mtime = os.stat(song_path).st_mtime
 
-    #         query = "SELECT tags FROM tracks WHERE path = ? AND checksum = ?"
-    #         cursor.execute(query, (song_path, song_mtime))
-    #         rows = cursor.fetchall()
+    # First try to load tags from the cache for speed
+    cached = get_cache().get(song_path)
 
-    #         if rows != []:
-    #             import ast
-    #             song_dict = rows[0][0]
-    #             song_dict = ast.literal_eval(song_dict)
-
-    #             return song_dict
-
-    #     except sqlite3.Error as e:
-    #         log.info("Error while accessing local_tags database", e)
+    if cached is not disk_cache.missing and cached["mtime"] == song_mtime:
+        return cached["tags"]
 
     song_dict = {}
 
@@ -134,15 +130,6 @@ def tags(song_path):
     # Add location of music file to dictionary
     song_dict["location"] = song_path
 
-    # with sqlite3.connect(db_file) as conn:
-    #     cursor = conn.cursor()
-    #     try:
-    #         query = "REPLACE INTO tracks (tags, checksum, path) VALUES(?, ?, ?)"
-    #         cursor.execute(
-    #             query, (str(song_dict), song_mtime, song_path))
-    #         conn.commit()
-
-    #     except sqlite3.Error as e:
-    #         log.info("Error while updating local_tags database", e)
+    get_cache().set(song_path, {"mtime": song_mtime, "tags": song_dict})
 
     return song_dict
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+parallel
+Run slow, independent tasks (usually api requests) concurrently.
+
+XDGFX, 2020
+"""
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from ultrasonics import logs, profiler
+
+log = logs.create_log(__name__)
+
+# Default number of threads used by each call to `map`
+default_threads = 8
+
+
+def map(func, items, threads=default_threads, desc=None):
+    """
+    Call `func` on every item using up to `threads` threads, and return the results in the same order as
+    `items`. Context variables are carried into the worker threads, and if the calling plugin run is being
+    profiled, each task is traced and sampled as part of that profile.
+
+    If any call raises an exception, tasks which haven't started are cancelled and the exception is raised.
+    If `desc` is supplied, a progress bar is shown.
+    """
+    items = list(items)
+
+    def task(item):
+        with profiler.worker():
+            return func(item)
+
+    if not items:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(items))) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, task, item)
+            for item in items
+        ]
+
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc, disable=desc is None):
+                future.result()
+
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return [future.result() for future in futures]
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+playlist_diff
+Computes the operations needed to turn an existing playlist into a target playlist.
+
+Rather than clearing a playlist and adding everything again, only the tracks which changed are touched:
+    1. Tracks not in the target (and repeated occurrences of target tracks) are removed.
+    2. The longest run of remaining tracks which are already in the right order stays in place, and every
+       other track is moved, with neighbouring tracks moved together.
+    3. New tracks are inserted at their target positions, with neighbouring tracks added together.
+
+Each operation is limited to `batch_size` tracks, the maximum allowed by the Spotify api.
+
+Tracks are identified by any hashable value (e.g. uri). Existing tracks with a value of None (e.g. local
+files which can't be matched) are left where they are.
+
+XDGFX, 2020
+"""
+
+from bisect import bisect_left
+
+from ultrasonics import logs
+
+log = logs.create_log(__name__)
+
+batch_size = 100
+
+
+def diff(existing, target):
+    """
+    Compute the operations which turn `existing` into `target`. `target` must not contain repeated tracks.
+
+    @return: list of operations, each one of:
+        ("remove", [(track, [positions]), ...])
+        ("move", range_start, range_length, insert_before)
+        ("add", [tracks], position)
+    Positions refer to the playlist after all previous operations have been applied.
+    """
+    operations = []
+    target_set = set(target)
+
+    # 1. Removals
+    current = list(existing)
+    seen = set()
+    removals = []
+
+    for position, track in enumerate(current):
+        if track is None:
+            continue
+
+        if track not in target_set or track in seen:
+            removals.append((track, position))
+
+        seen.add(track)
+
+    # Each removal batch shifts the positions used by the next one, so track them as batches are made
+    while removals:
+        batch = {}
+        for track, position in removals:
+            if len(batch) == batch_size and track not in batch:
+                break
+            batch.setdefault(track, []).append(position)
+
+        operations.append(("remove", list(batch.items())))
+
+        removed = {position for positions in batch.values()
+                   for position in positions}
+        removals = [
+            (track, position - sum(1 for r in removed if r < position))
+            for track, position in removals if position not in removed
+        ]
+        current = [track for position, track in enumerate(current)
+                   if position not in removed]
+
+    # 2. Moves
+    kept = [track for track in target if track in seen]
+    order = {track: i for i, track in enumerate(kept)}
+    stable = longest_increasing([order[track]
+                                 for track in current if track is not None])
+
+    i = 0
+    while i < len(kept):
+        if order[kept[i]] in stable:
+            i += 1
+            continue
+
+        start = current.index(kept[i])
+
+        # Move neighbouring tracks which also need to follow this one
+        length = 1
+        while (i + length < len(kept)
+               and order[kept[i + length]] not in stable
+               and start + length < len(current)
+               and current[start + length] == kept[i + length]
+               and length < batch_size):
+            length += 1
+
+        if i:
+            insert_before = current.index(kept[i - 1]) + 1
+        else:
+            insert_before = first_position(current, order)
+
+        if insert_before not in (start, start + length):
+            operations.append(("move", start, length, insert_before))
+
+            moved = current[start:start + length]
+            del current[start:start + length]
+
+            if insert_before > start:
+                insert_before -= length
+
+            current[insert_before:insert_before] = moved
+
+        i += length
+
+    # 3. Additions
+    i = 0
+    while i < len(target):
+        if target[i] in seen:
+            i += 1
+            continue
+
+        run = []
+        while i + len(run) < len(target) and target[i + len(run)] not in seen and len(run) < batch_size:
+            run.append(target[i + len(run)])
+
+        if i:
+            position = current.index(target[i - 1]) + 1
+        else:
+            position = first_position(current, order)
+
+        operations.append(("add", run, position))
+
+        current[position:position] = run
+        order.update({track: None for track in run})
+        seen.update(run)
+
+        i += len(run)
+
+    return operations
+
+
+def first_position(current, order):
+    """
+    Position of the first track in `current` which is part of the target, or the end if there isn't one.
+    """
+    for position, track in enumerate(current):
+        if track in order:
+            return position
+
+    return len(current)
+
+
+def longest_increasing(values):
+    """
+    Longest strictly increasing subsequence of `values`, returned as a set of values.
+    """
+    tails = []
+    tail_index = []
+    previous = [None] * len(values)
+
+    for i, value in enumerate(values):
+        j = bisect_left(tails, value)
+
+        if j == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[j] = value
+            tail_index[j] = i
+
+        previous[i] = tail_index[j - 1] if j else None
+
+    result = set()
+    i = tail_index[-1] if tail_index else None
+
+    while i is not None:
+        result.add(values[i])
+        i = previous[i]
+
+    return result
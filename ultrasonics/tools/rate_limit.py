@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+rate_limit
+Token bucket rate limiters, shared by name between every plugin instance talking to the same service.
+
+Call `acquire()` before each request. If a service responds with a rate limit error, call `penalise()` with
+the number of seconds it asks for (e.g. from a `Retry-After` header), and every thread using that limiter
+will wait before making another request.
+
+XDGFX, 2020
+"""
+
+import email.utils
+import threading
+import time
+
+from ultrasonics import logs, metrics
+
+log = logs.create_log(__name__)
+
+limiters = {}
+lock = threading.Lock()
+
+wait_seconds = metrics.Histogram("ultrasonics_rate_limit_wait_seconds",
+                                 "Time spent waiting for a rate limiter before making a request.")
+
+
+class RateLimiter:
+    """
+    Allows `rate` requests every `per` seconds, with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, name, rate, per=1, burst=None):
+        self.name = name
+        self.rate = rate / per
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request can be made.
+        """
+        start = time.monotonic()
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+        waited = time.monotonic() - start
+        if waited:
+            wait_seconds.observe(waited, limiter=self.name)
+
+    def penalise(self, seconds):
+        """
+        Stop all requests for `seconds`, e.g. after the service returns a rate limit error.
+        """
+        with self.lock:
+            self.blocked_until = max(
+                self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def get(name, rate, per=1, burst=None):
+    """
+    Get the shared limiter called `name`, creating it if needed.
+    The rate settings are only used when the limiter is first created.
+    """
+    with lock:
+        if name not in limiters:
+            limiters[name] = RateLimiter(name, rate, per, burst)
+
+        return limiters[name]
+
+
+def retry_after(headers, default=5):
+    """
+    Read the number of seconds to wait from a `Retry-After` header, which can be seconds or a http date.
+    """
+    value = (headers or {}).get("Retry-After")
+
+    if not value:
+        return default
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+spotify_token
+Shared Spotify access token manager.
+
+Access tokens are kept in memory along with their expiry time, and renewed through ultrasonics-api shortly
+before they expire, so no requests are wasted validating them. Token state is shared by every plugin
+instance using the same refresh token, and a lock makes sure only one renewal is requested at a time, even
+when many applets run concurrently.
+
+Tokens are also cached to disk, so they can be reused after a restart. The shared http session and rate
+limiter used for the Spotify web api are also provided here, so every Spotify plugin uses the same connection
+pool and request budget.
+
+XDGFX, 2020
+"""
+
+import bz2
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from urllib.parse import urljoin
+
+import urllib3
+
+from app import _ultrasonics
+from ultrasonics import logs, sessions
+from ultrasonics.tools import api_key, rate_limit
+
+log = logs.create_log(__name__)
+
+cache_file = os.path.join(
+    _ultrasonics["config_dir"], "up_spotify", "up_spotify.bz2")
+
+# Renew tokens this many seconds before they expire
+expiry_margin = 300
+
+# Don't renew a token again if it was renewed this many seconds ago
+renew_interval = 30
+
+spotify_url = "https://api.spotify.com"
+
+# Shared by every Spotify plugin instance. Rate limit errors are handled by `penalise`-ing this limiter,
+# rather than retrying in the session, so all threads back off together.
+limiter = rate_limit.get("spotify", rate=20, per=1)
+
+# In memory token state, keyed by refresh token
+tokens = {}
+lock = threading.Lock()
+
+
+class TokenManager:
+    """
+    Spotipy auth manager, which supplies a valid access token for every request.
+    """
+
+    def __init__(self, api_url, refresh_token):
+        self.api_url = api_url
+        self.refresh_token = refresh_token
+
+    def get_access_token(self, as_dict=False):
+        """
+        Called by spotipy before each request.
+        """
+        return get(self.api_url, self.refresh_token)
+
+    def renew(self):
+        """
+        Force renewal of the access token, e.g. after it is rejected by Spotify.
+        """
+        return get(self.api_url, self.refresh_token, force=True)
+
+
+def get(api_url, refresh_token, force=False):
+    """
+    Get an access token for `refresh_token`, in the following order of preference:
+    1. The token held in memory, if it is not close to expiry.
+    2. The token cached on disk, if it is not close to expiry.
+    3. A new token from ultrasonics-api.
+
+    If `force`, the token is renewed unless it was already renewed in the last `renew_interval` seconds.
+    """
+    with lock:
+        token = tokens.get(refresh_token) or cache_load(refresh_token)
+
+        if token:
+            tokens[refresh_token] = token
+
+            if force:
+                if time.time() - token["renewed_at"] < renew_interval:
+                    log.debug("Token was renewed recently, using that one.")
+                    return token["access_token"]
+
+            elif token["expires_at"] - expiry_margin > time.time():
+                return token["access_token"]
+
+        token = renew(api_url, refresh_token)
+        tokens[refresh_token] = token
+        cache_save(refresh_token, token)
+
+        return token["access_token"]
+
+
+def renew(api_url, refresh_token):
+    """
+    Using refresh_token, requests a new access token from ultrasonics-api.
+    """
+    url = urljoin(api_url, "spotify/auth/renew")
+    data = {
+        "refresh_token": refresh_token,
+        "ultrasonics_auth_hash": api_key.get_hash(True),
+    }
+
+    log.info("Requesting a new Spotify token, this may take a few seconds...")
+
+    # Request with a long timeout to account for free Heroku start-up 😉
+    resp = sessions.get(url).post(url, data=data, timeout=60)
+
+    if resp.status_code != 200:
+        log.error(resp.text)
+        raise Exception(
+            f"The response when renewing Spotify token was unexpected: {resp.status_code}")
+
+    raw = resp.json()
+
+    log.debug(
+        f"Spotify renew data: {resp.text.replace(raw['access_token'], '***************')}")
+
+    renewed_at = time.time()
+
+    return {
+        "access_token": raw["access_token"],
+        "expires_at": renewed_at + int(raw.get("expires_in") or 3600),
+        "renewed_at": renewed_at
+    }
+
+
+def session():
+    """
+    Get the shared session for the Spotify web api, which retries server errors in the same way as spotipy's
+    own sessions.
+    """
+    retries = urllib3.Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504))
+
+    return sessions.get(spotify_url, retries=retries)
+
+
+def cache_load(refresh_token):
+    """
+    Load a token from the disk cache, if it belongs to `refresh_token`.
+    """
+    if not os.path.isfile(cache_file):
+        return None
+
+    try:
+        with bz2.BZ2File(cache_file, "r") as f:
+            raw = json.loads(pickle.load(f))
+    except Exception as e:
+        log.warning(f"Could not read cached Spotify token: {e}")
+        return None
+
+    # Tokens cached by older versions don't store an expiry, so are renewed
+    if raw.get("refresh_hash") != refresh_hash(refresh_token) or "expires_at" not in raw:
+        return None
+
+    return {key: raw[key] for key in ["access_token", "expires_at", "renewed_at"]}
+
+
+def cache_save(refresh_token, token):
+    """
+    Save a token to the disk cache.
+    """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+    raw = dict(token, refresh_hash=refresh_hash(refresh_token))
+
+    with bz2.BZ2File(cache_file, "w") as f:
+        pickle.dump(json.dumps(raw), f)
+
+
+def refresh_hash(refresh_token):
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
@@ -10,10 +10,10 @@ XDGFX, 2020
 import copy
 import os
 
-from flask import Flask, redirect, render_template, request
+from flask import Flask, Response, abort, redirect, render_template, request, send_from_directory
 from flask_socketio import SocketIO, emit, send
 
-from ultrasonics import database, logs, plugins
+from ultrasonics import database, logs, metrics, plugins, profiler
 from ultrasonics.tools import random_words
 
 log = logs.create_log(__name__)
@@ -50,6 +50,9 @@ def html_index():
         # Send applet plans to builder and reset to default
         Applet.current_plans["applet_name"] = request.args.get(
             'applet_name') or random_words.name()
+        Applet.current_plans["profile"] = request.args.get('profile') == "on"
+        Applet.current_plans["force_run"] = request.args.get(
+            'force_run') == "on"
 
         plugins.applet_build(Applet.current_plans)
         Applet.current_plans = copy.deepcopy(Applet.default_plans)
@@ -73,12 +76,12 @@ def html_index():
         return redirect(request.path, code=302)
 
     elif action == 'run':
-        from ultrasonics.scheduler import pool
+        from ultrasonics.scheduler import submit
 
         applet_id = request.args.get('applet_id')
 
         # plugins.applet_run(applet_id)
-        pool.submit(plugins.applet_run, applet_id)
+        submit(plugins.applet_run, applet_id)
         return redirect(request.path, code=302)
 
     elif action == 'new_install':
@@ -104,7 +107,9 @@ class Applet:
         "inputs": [],
         "modifiers": [],
         "outputs": [],
-        "triggers": []
+        "triggers": [],
+        "profile": False,
+        "force_run": False
     }
 
     current_plans = copy.deepcopy(default_plans)
@@ -270,6 +275,38 @@ def html_settings():
     return render_template("settings.html", settings=settings)
 
 
+@app.route('/profiles')
+def html_profiles():
+    """
+    List the results of profiled plugin runs.
+    """
+    profiles = database.Profile().gather(limit=profiler.profiles_limit)
+
+    applet_names = {applet["applet_id"]: applet["applet_plans"]["applet_name"]
+                    for applet in plugins.applet_gather()}
+
+    return render_template("profiles.html", profiles=profiles, applet_names=applet_names)
+
+
+@app.route('/profiles/<profile_id>.<file_type>')
+def download_profile(profile_id, file_type):
+    """
+    Download a saved profile trace.
+    """
+    if file_type not in ["prof", "folded"]:
+        abort(404)
+
+    return send_from_directory(os.path.abspath(profiler.profiles_dir), f"{profile_id}.{file_type}", as_attachment=True)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Operational metrics in Prometheus text format. Only reads from memory, so it is cheap to scrape.
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 # Welcome Page
 @app.route('/welcome')
 def html_welcome():